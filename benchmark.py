@@ -0,0 +1,232 @@
+# Title: Reproducible CPU benchmark of the detection pipeline with a synthetic detector
+#
+# Runs decode -> (synthetic) inference -> ROI/class filtering -> drawing -> output
+# writing over a video for every saved ROI session and box count, and writes
+# frames/sec, per-stage latency and peak memory to a JSON result file.
+# No model, GUI or network is needed, so results are comparable between runs.
+# Every scenario runs in a fresh process, so its peak RSS is its own.
+#
+# Usage:
+#   python benchmark.py --boxes 10 100 --frames 300 --output bench_results.json
+
+import argparse
+import glob
+import json
+import multiprocessing as mp
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+from detection_filter import DetectionFilter, Detections, draw_detections
+from instrumentation import StageTimer
+from outputs import JsonlDetectionWriter, VideoWriterThread
+from pipeline import FramePipeline
+from roi_index import ROIIndex, load_roi_session
+from roi_overlay import ROIOverlay
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+COCO_NAMES = {i: f"class_{i}" for i in range(80)}
+
+
+class SyntheticDetector:
+    """Deterministic stand-in for the YOLO model.
+
+    Emits boxes_per_frame boxes per frame with sizes, classes and
+    confidences drawn from a generator seeded by (seed, frame number), so
+    every run sees exactly the same detections.
+    """
+
+    def __init__(self, frame_width, frame_height, boxes_per_frame, seed=0, num_classes=10):
+        self.frame_width = frame_width
+        self.frame_height = frame_height
+        self.boxes_per_frame = boxes_per_frame
+        self.seed = seed
+        self.num_classes = num_classes
+        self.frame_number = 0
+
+    def detect(self):
+        self.frame_number += 1
+        rng = np.random.default_rng((self.seed, self.frame_number))
+        n = self.boxes_per_frame
+        wh = rng.uniform(10, 80, (n, 2))
+        xy = rng.uniform(0, 1, (n, 2)) * [self.frame_width, self.frame_height] - wh / 2
+        xyxy = np.hstack([xy, xy + wh]).astype(np.float32)
+        conf = rng.uniform(0.05, 1.0, n).astype(np.float32)
+        cls = rng.integers(0, self.num_classes, n).astype(np.int32)
+        return Detections(xyxy, conf, cls)
+
+    def __call__(self, frames):
+        return [self.detect() for _ in frames]
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes on Linux
+    return round(peak / (1 << 20) if sys.platform == "darwin" else peak / 1024, 1)
+
+
+def run_isolated(*scenario):
+    """run_scenario() in a freshly spawned process; ru_maxrss is per process, so
+    scenarios run in one process would each report the peak of all earlier ones."""
+    with mp.get_context("spawn").Pool(1) as pool:
+        return pool.apply(run_scenario, scenario)
+
+
+def run_scenario(video_path, session, boxes_per_frame, max_frames, out_dir, args):
+    # Single-threaded OpenCV keeps numbers stable between machines and runs
+    cv2.setNumThreads(1)
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        raise IOError(f"Could not open video file '{video_path}'")
+    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    fps = cap.get(cv2.CAP_PROP_FPS)
+
+    roi_names, polygons, _ = load_roi_session(session, (width, height))
+    roi_index = ROIIndex(polygons, roi_names, width, height)
+    detection_filter = DetectionFilter(roi_index, args.classes, args.conf_threshold)
+    roi_overlay = ROIOverlay(polygons, roi_names)
+    detector = SyntheticDetector(width, height, boxes_per_frame, args.seed)
+    # Window large enough to hold every sample, including frames still queued at the end
+    timer = StageTimer(window=max_frames + 64, report_interval=float("inf"))
+
+    def annotate(packet):
+        started = time.perf_counter()
+        packet.detections = detection_filter(packet.raw)
+        timer.record("filter", time.perf_counter() - started)
+
+        started = time.perf_counter()
+        draw_detections(packet.frame, packet.detections, COCO_NAMES)
+        roi_overlay.apply(packet.frame)
+        timer.record("draw", time.perf_counter() - started)
+
+    name = f"{os.path.basename(os.path.normpath(session))}_{boxes_per_frame}"
+    jsonl_writer = JsonlDetectionWriter(os.path.join(out_dir, name + ".jsonl"), COCO_NAMES, roi_index)
+    video_writer = None
+    if args.write_video:
+        video_writer = VideoWriterThread(os.path.join(out_dir, name + ".mp4"), fps, (width, height))
+
+    if args.tracemalloc:
+        tracemalloc.start()
+    pipeline = FramePipeline(cap, detector, annotate, batch_size=args.batch_size, timer=timer)
+    frames = 0
+    kept = 0
+    started = time.perf_counter()
+    try:
+        for packet in pipeline:
+            output_started = time.perf_counter()
+            jsonl_writer.write(packet)
+            if video_writer is not None:
+                video_writer.write(packet.frame)
+            timer.record("output", time.perf_counter() - output_started)
+
+            frames += 1
+            kept += len(packet.detections)
+            if frames >= max_frames:
+                break
+    finally:
+        pipeline.stop()
+        jsonl_writer.close()
+        if video_writer is not None:
+            video_writer.close()
+        cap.release()
+    elapsed = time.perf_counter() - started
+
+    python_peak_mb = None
+    if args.tracemalloc:
+        python_peak_mb = round(tracemalloc.get_traced_memory()[1] / (1 << 20), 2)
+        tracemalloc.stop()
+
+    stages = timer.percentiles()
+    for stage, stats in stages.items():
+        values = timer.samples[stage][:min(timer.counts[stage], timer.window)]
+        stats["total_s"] = round(float(values.sum()), 4)
+
+    return {
+        "video": video_path,
+        "roi_session": session,
+        "num_rois": len(roi_index),
+        "frame_size": [width, height],
+        "boxes_per_frame": boxes_per_frame,
+        "frames": frames,
+        "kept_detections": kept,
+        "seconds": round(elapsed, 4),
+        "fps": round(frames / elapsed, 2) if elapsed > 0 else 0.0,
+        "stages": stages,
+        "peak_rss_mb": peak_rss_mb(),
+        "python_peak_mb": python_peak_mb,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the detection pipeline with a synthetic detector")
+    parser.add_argument("--video", default="intersectionRoad1.mp4")
+    parser.add_argument("--sessions", nargs="*", default=None,
+                        help="ROI session folders (default: every roi_mapping_results/* session)")
+    parser.add_argument("--boxes", nargs="+", type=int, default=[10, 100],
+                        help="Synthetic boxes per frame, one scenario each")
+    parser.add_argument("--frames", type=int, default=300, help="Frames per scenario")
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--classes", nargs="+", type=int, default=[1, 2, 3, 5, 7, 9])
+    parser.add_argument("--conf-threshold", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--write-video", action="store_true", help="Also encode an annotated MP4")
+    parser.add_argument("--tracemalloc", action="store_true",
+                        help="Measure peak Python heap per scenario (slows the run down)")
+    parser.add_argument("--output", default="bench_results.json")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.video):
+        print(f"Error: Video file '{args.video}' not found!")
+        sys.exit(1)
+    sessions = args.sessions or sorted(glob.glob(os.path.join("roi_mapping_results", "*", "roi_polygons.json")))
+    sessions = [os.path.dirname(s) if s.endswith(".json") else s for s in sessions]
+    if not sessions:
+        print("Error: No ROI sessions found")
+        sys.exit(1)
+
+    out_dir = tempfile.mkdtemp(prefix="bench_")
+    results = []
+    try:
+        for session in sessions:
+            for boxes in args.boxes:
+                result = run_isolated(args.video, session, boxes, args.frames, out_dir, args)
+                results.append(result)
+                print(f"{os.path.basename(session)} boxes={boxes}: {result['fps']} FPS "
+                      f"({result['frames']} frames, {result['kept_detections']} kept)")
+    finally:
+        shutil.rmtree(out_dir, ignore_errors=True)
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+            "cpu_count": os.cpu_count(),
+            "numpy": np.__version__,
+            "opencv": cv2.__version__,
+        },
+        "config": {k: v for k, v in vars(args).items() if k != "output"},
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
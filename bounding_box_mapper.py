@@ -33,6 +33,11 @@ class PolygonROIMapper:
         self.polygon_names = []
         self.drawing = False
         self.current_name = ""
+        # Original frame with the completed polygons drawn; rebuilt only when they change
+        self.completed_layer = np.empty_like(frame)
+        self.completed_dirty = True
+        # Canvas for the mouse-move preview, redrawn in place instead of copying the frame
+        self.preview = np.empty_like(frame)
         
     def mouse_callback(self, event, x, y, flags, param):
         if event == cv2.EVENT_LBUTTONDOWN:
@@ -51,25 +56,31 @@ class PolygonROIMapper:
         elif event == cv2.EVENT_MOUSEMOVE:
             # Show preview of next point
             if len(self.current_polygon) > 0:
-                temp_frame = self.frame.copy()
+                np.copyto(self.preview, self.frame)
                 # Draw line from last point to current mouse position
-                cv2.line(temp_frame, self.current_polygon[-1], (x, y), (0, 255, 255), 1)
-                cv2.putText(temp_frame, f"Mouse: ({x}, {y})", (x + 10, y - 10),
+                cv2.line(self.preview, self.current_polygon[-1], (x, y), (0, 255, 255), 1)
+                cv2.putText(self.preview, f"Mouse: ({x}, {y})", (x + 10, y - 10),
                            cv2.FONT_HERSHEY_SIMPLEX, 0.4, (0, 255, 255), 1)
-                cv2.imshow("ROI Polygon Mapper", temp_frame)
+                cv2.imshow("ROI Polygon Mapper", self.preview)
     
-    def draw_current_polygon(self):
-        self.frame = self.original_frame.copy()
+    def render_completed_layer(self):
+        np.copyto(self.completed_layer, self.original_frame)
+        self.completed_dirty = False
         
         # Draw all completed polygons
         for i, polygon in enumerate(self.polygons):
             pts = np.array(polygon, np.int32)
-            cv2.fillPoly(self.frame, [pts], (0, 255, 0, 50))  # Semi-transparent fill
-            cv2.polylines(self.frame, [pts], True, (0, 255, 0), 2)
+            cv2.fillPoly(self.completed_layer, [pts], (0, 255, 0, 50))  # Semi-transparent fill
+            cv2.polylines(self.completed_layer, [pts], True, (0, 255, 0), 2)
             # Add polygon label
             if len(polygon) > 0:
-                cv2.putText(self.frame, self.polygon_names[i], polygon[0],
+                cv2.putText(self.completed_layer, self.polygon_names[i], polygon[0],
                            cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 0), 2)
+    
+    def draw_current_polygon(self):
+        if self.completed_dirty:
+            self.render_completed_layer()
+        np.copyto(self.frame, self.completed_layer)
         
         # Draw current polygon being created
         if len(self.current_polygon) > 0:
@@ -107,6 +118,7 @@ class PolygonROIMapper:
             print(f"Points: {self.current_polygon}")
             
             self.current_polygon = []
+            self.completed_dirty = True
             self.draw_current_polygon()
     
     def clear_current(self):
@@ -118,6 +130,7 @@ class PolygonROIMapper:
         self.current_polygon = []
         self.polygons = []
         self.polygon_names = []
+        self.completed_dirty = True
         self.draw_current_polygon()
         print("All polygons reset")
     
@@ -152,10 +165,13 @@ class PolygonROIMapper:
             "polygons": []
         }
         
+        # Normalized (0..1) copies let main.py use the ROIs at any resolution
+        height, width = self.original_frame.shape[:2]
         for i, polygon in enumerate(self.polygons):
             data["polygons"].append({
                 "name": self.polygon_names[i],
-                "points": polygon
+                "points": polygon,
+                "points_normalized": [[round(x / width, 6), round(y / height, 6)] for x, y in polygon]
             })
         
         json_file = os.path.join(session_folder, "roi_polygons.json")
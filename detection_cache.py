@@ -0,0 +1,145 @@
+# Title: Persistent on-disk cache of raw (unfiltered) detections per video frame
+
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+
+from detection_filter import Detections
+
+
+def file_sha1(path, cache_dir=None, chunk_size=1 << 20):
+    """SHA-1 of a file's content.
+
+    When cache_dir is given, hashes are remembered in cache_dir/file_hashes.json
+    under (path, size, mtime), so large videos are only read once.
+    """
+    stat = os.stat(path)
+    stamp = f"{os.path.abspath(path)}|{stat.st_size}|{stat.st_mtime_ns}"
+
+    known = {}
+    index_file = os.path.join(cache_dir, "file_hashes.json") if cache_dir else None
+    if index_file and os.path.exists(index_file):
+        try:
+            with open(index_file) as f:
+                known = json.load(f)
+        except (OSError, ValueError):
+            known = {}
+        if stamp in known:
+            return known[stamp]
+
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    sha1 = digest.hexdigest()
+
+    if index_file:
+        known[stamp] = sha1
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_file = index_file + ".tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(known, f, indent=2)
+        os.replace(tmp_file, index_file)
+    return sha1
+
+
+def cache_key(video_path, model_path, params, cache_dir=None):
+    """Key from video content, model weights and inference parameters."""
+    video_id = file_sha1(video_path, cache_dir)
+    # Weights that are not on disk yet (ultralytics auto-download) are keyed by name
+    model_id = file_sha1(model_path, cache_dir) if os.path.isfile(model_path) else os.path.basename(model_path)
+    blob = json.dumps({"video": video_id, "model": model_id, "params": params}, sort_keys=True)
+    return hashlib.sha1(blob.encode("utf-8")).hexdigest()
+
+
+class DetectionCache:
+    """Raw detections of a whole video, stored as two memory-mappable arrays.
+
+    boxes.npy is an (M, 6) float32 array of x1, y1, x2, y2, conf, cls rows for
+    all frames back to back; offsets.npy holds F+1 int64 row offsets, so the
+    boxes of frame i (1-based, as in FramePipeline) are
+    boxes[offsets[i-1]:offsets[i]]. A cache is only written for a complete,
+    gap-free run and is never modified afterwards.
+    """
+
+    def __init__(self, cache_dir, key):
+        self.path = os.path.join(cache_dir, key)
+        self.boxes = None
+        self.offsets = None
+        self.meta = {}
+        self.records = {}
+
+        if os.path.exists(os.path.join(self.path, "meta.json")):
+            try:
+                with open(os.path.join(self.path, "meta.json")) as f:
+                    self.meta = json.load(f)
+                self.boxes = np.load(os.path.join(self.path, "boxes.npy"), mmap_mode="r")
+                self.offsets = np.load(os.path.join(self.path, "offsets.npy"), mmap_mode="r")
+            except (OSError, ValueError) as e:
+                print(f"Warning: ignoring unreadable detection cache '{self.path}': {e}")
+                self.boxes = self.offsets = None
+                self.meta = {}
+
+    @property
+    def is_warm(self):
+        return self.offsets is not None
+
+    @property
+    def frame_count(self):
+        return 0 if self.offsets is None else self.offsets.shape[0] - 1
+
+    @property
+    def class_names(self):
+        return {int(k): v for k, v in self.meta.get("class_names", {}).items()}
+
+    def lookup(self, index):
+        """Return the cached raw Detections of a frame, or None on a miss."""
+        if self.offsets is None or not 1 <= index <= self.frame_count:
+            return None
+        rows = self.boxes[self.offsets[index - 1]:self.offsets[index]]
+        return Detections(np.array(rows[:, :4]), np.array(rows[:, 4]), rows[:, 5].astype(np.int32))
+
+    def store(self, index, raw):
+        if self.offsets is not None:
+            return
+        rows = np.empty((len(raw), 6), np.float32)
+        rows[:, :4] = raw.xyxy
+        rows[:, 4] = raw.conf
+        rows[:, 5] = raw.cls
+        self.records[index] = rows
+
+    def save(self, class_names, frame_count, frame_stride=1):
+        """Write frames 1..frame_count; returns False if an analyzed frame is missing.
+
+        With a frame stride only frames 1, 1+stride, ... are expected; the
+        skipped frames are stored without boxes.
+        """
+        if self.offsets is not None or not self.records:
+            return False
+        if sorted(self.records) != list(range(1, frame_count + 1, frame_stride)):
+            return False
+
+        empty = np.zeros((0, 6), np.float32)
+        parts = [self.records.get(i, empty) for i in range(1, frame_count + 1)]
+        offsets = np.zeros(frame_count + 1, np.int64)
+        offsets[1:] = np.cumsum([len(p) for p in parts])
+        boxes = np.concatenate(parts) if parts else np.zeros((0, 6), np.float32)
+
+        tmp_path = self.path + ".tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        np.save(os.path.join(tmp_path, "boxes.npy"), boxes)
+        np.save(os.path.join(tmp_path, "offsets.npy"), offsets)
+        with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+            json.dump({"frame_count": frame_count,
+                       "class_names": {str(k): v for k, v in class_names.items()}}, f, indent=2)
+        try:
+            os.replace(tmp_path, self.path)
+        except OSError:
+            # Another run already stored the same key
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            return False
+        return True
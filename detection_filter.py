@@ -0,0 +1,182 @@
+# Title: Vectorized class / confidence / ROI filtering of YOLOv8 detections
+
+import cv2
+import numpy as np
+
+from roi_rules import ROIRuleTable
+
+# IoU pairs computed at once by Detections.nms (bounds its memory for large candidate sets)
+NMS_BLOCK_ELEMENTS = 1 << 18
+
+
+def iou_matrix(a, b):
+    """Pairwise IoU of (N, 4) and (M, 4) xyxy boxes as an (N, M) array."""
+    if len(a) == 0 or len(b) == 0:
+        return np.zeros((len(a), len(b)), np.float32)
+    x1 = np.maximum(a[:, None, 0], b[None, :, 0])
+    y1 = np.maximum(a[:, None, 1], b[None, :, 1])
+    x2 = np.minimum(a[:, None, 2], b[None, :, 2])
+    y2 = np.minimum(a[:, None, 3], b[None, :, 3])
+    inter = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    return inter / np.maximum(area_a[:, None] + area_b[None, :] - inter, 1e-6)
+
+
+class Detections:
+    """Struct-of-arrays view of the detections of a single frame.
+
+    xyxy is (N, 4) float32, conf is (N,) float32, cls is (N,) int32 and
+    roi_bits is the (N,) ROI bitmask from ROIIndex (None for raw,
+    unfiltered detections). track_ids is (N,) int64 when the detections
+    come from the tracker, otherwise None.
+    """
+
+    __slots__ = ("xyxy", "conf", "cls", "roi_bits", "track_ids")
+
+    def __init__(self, xyxy, conf, cls, roi_bits=None, track_ids=None):
+        self.xyxy = xyxy
+        self.conf = conf
+        self.cls = cls
+        self.roi_bits = roi_bits
+        self.track_ids = track_ids
+
+    @classmethod
+    def empty(cls):
+        return cls(np.zeros((0, 4), np.float32), np.zeros(0, np.float32), np.zeros(0, np.int32))
+
+    @classmethod
+    def from_boxes(cls, boxes):
+        """Convert an ultralytics Boxes object with one device-to-host copy."""
+        data = boxes.data.cpu().numpy()
+        return cls(np.ascontiguousarray(data[:, :4], np.float32),
+                   data[:, -2].astype(np.float32),
+                   data[:, -1].astype(np.int32))
+
+    @classmethod
+    def concatenate(cls, parts):
+        if not parts:
+            return cls.empty()
+        if len(parts) == 1:
+            return parts[0]
+        return cls(np.concatenate([p.xyxy for p in parts]),
+                   np.concatenate([p.conf for p in parts]),
+                   np.concatenate([p.cls for p in parts]))
+
+    def __len__(self):
+        return self.cls.shape[0]
+
+    def offset(self, dx, dy):
+        """Return a copy with boxes shifted by (dx, dy), e.g. from crop to frame coordinates."""
+        shift = np.array([dx, dy, dx, dy], np.float32)
+        return Detections(self.xyxy + shift, self.conf, self.cls, self.roi_bits, self.track_ids)
+
+    def scaled(self, sx, sy):
+        """Return a copy with boxes scaled by (sx, sy), e.g. from a downscaled frame to the source."""
+        factor = np.array([sx, sy, sx, sy], np.float32)
+        return Detections(self.xyxy * factor, self.conf, self.cls, self.roi_bits, self.track_ids)
+
+    def select(self, mask):
+        roi_bits = None if self.roi_bits is None else self.roi_bits[mask]
+        track_ids = None if self.track_ids is None else self.track_ids[mask]
+        return Detections(self.xyxy[mask], self.conf[mask], self.cls[mask], roi_bits, track_ids)
+
+    def nms(self, iou_threshold=0.5):
+        """Class-aware non-maximum suppression, e.g. across overlapping tiles.
+
+        The greedy pass visits boxes highest confidence first and suppresses
+        all overlaps of a kept box with one row operation. IoU rows are
+        computed a block at a time (about NMS_BLOCK_ELEMENTS pairs), only for
+        boxes not suppressed yet, so thousands of candidates need a few MB
+        instead of a dense N x N matrix.
+        """
+        if len(self) < 2:
+            return self
+        order = np.argsort(-self.conf, kind="stable")
+        boxes = self.xyxy[order]
+        cls = self.cls[order]
+        n = len(order)
+        block = max(32, NMS_BLOCK_ELEMENTS // n)
+
+        keep = np.ones(n, bool)
+        for start in range(0, n, block):
+            rows = np.nonzero(keep[start:start + block])[0] + start
+            if rows.size == 0:
+                continue
+            later = keep[start:]
+            overlap = ((iou_matrix(boxes[rows], boxes[start:]) > iou_threshold) &
+                       (cls[rows, None] == cls[None, start:]))
+            # A box can only suppress lower-confidence boxes
+            overlap &= np.arange(start, n)[None, :] > rows[:, None]
+            for k in np.nonzero(overlap.any(axis=1))[0].tolist():
+                if keep[rows[k]]:
+                    later[overlap[k]] = False
+        return self.select(np.sort(order[keep]))
+
+    def centers(self):
+        """Return integer (x, y) center coordinates of every box."""
+        cx = ((self.xyxy[:, 0] + self.xyxy[:, 2]) / 2).astype(np.int32)
+        cy = ((self.xyxy[:, 1] + self.xyxy[:, 3]) / 2).astype(np.int32)
+        return cx, cy
+
+    def labels(self, class_names):
+        return [class_names[c] for c in self.cls.tolist()]
+
+
+class DetectionFilter:
+    """Keeps detections whose box center lies inside an ROI whose rules
+    allow the detection's class at its confidence.
+
+    Without rules, every ROI allows allowed_class_ids at conf_threshold.
+    rules (see roi_rules.py) give each ROI its own classes and confidence
+    floors; they are compiled into an ROIRuleTable for the current ROI set
+    and recompiled by set_roi_index(). Each kept detection's roi_bits only
+    contains the ROIs whose rules it passed.
+    """
+
+    def __init__(self, roi_index, allowed_class_ids, conf_threshold=0.0, rules=None):
+        self.allowed_class_ids = sorted(set(int(c) for c in allowed_class_ids))
+        self.conf_threshold = float(conf_threshold)
+        self.rules = rules
+        self.set_roi_index(roi_index)
+
+    def set_roi_index(self, roi_index):
+        # Build the table before publishing the ROI set, so a frame never mixes the two
+        table = ROIRuleTable(roi_index.names, self.rules, self.allowed_class_ids, self.conf_threshold)
+        self.roi_index, self.table = roi_index, table
+
+    def __call__(self, detections):
+        roi_index, table = self.roi_index, self.table
+        min_conf = table.min_conf
+        cls = detections.cls
+        # Cheap pre-filter: classes no ROI allows and confidences below every threshold
+        keep = (cls < table.num_classes) & (detections.conf >= table.model_conf)
+
+        kept = detections.select(keep)
+        cx, cy = kept.centers()
+        roi_bits = roi_index.lookup(cx, cy)
+        inside = roi_bits != 0
+        kept = kept.select(inside)
+        roi_bits = roi_bits[inside]
+
+        # One gather of the (ROI, class) thresholds for every (detection, ROI) pair
+        passed = roi_index.membership(roi_bits) & (kept.conf[:, None] >= min_conf[:, kept.cls].T)
+        shifts = np.arange(len(roi_index), dtype=roi_index.dtype)
+        roi_bits = np.bitwise_or.reduce(passed.astype(roi_index.dtype) << shifts, axis=1)
+
+        accepted = roi_bits != 0
+        kept = kept.select(accepted)
+        kept.roi_bits = roi_bits[accepted]
+        return kept
+
+
+def draw_detections(frame, detections, class_names, color=(0, 255, 0)):
+    """Draw boxes and 'label conf' captions for filtered detections."""
+    boxes = detections.xyxy.astype(np.int32).tolist()
+    labels = detections.labels(class_names)
+    if detections.track_ids is not None:
+        labels = [f"#{track_id} {label}" for track_id, label in zip(detections.track_ids.tolist(), labels)]
+    for (x1, y1, x2, y2), label, conf in zip(boxes, labels, detections.conf.tolist()):
+        cv2.rectangle(frame, (x1, y1), (x2, y2), color, 2)
+        cv2.putText(frame, f"{label} {conf:.2f}", (x1, y1 - 10),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.6, color, 2)
@@ -0,0 +1,256 @@
+# Title: Append-only columnar store of filtered detections with time-window queries
+#
+# Usage (query an existing store):
+#   python event_store.py detection_events --bucket 60
+
+import argparse
+import json
+import os
+import shutil
+import sys
+
+import numpy as np
+
+# One row per (detection, ROI) pair; a detection inside two overlapping ROIs is two rows
+COLUMNS = {
+    "frame": (np.int64, ()),
+    "timestamp": (np.float64, ()),   # seconds: start_time + video timestamp
+    "roi_id": (np.int16, ()),
+    "class_id": (np.int16, ()),
+    "conf": (np.float32, ()),
+    "box": (np.float32, (4,)),
+    "track_id": (np.int64, ()),      # -1 when the tracker is off
+}
+
+
+class EventStore:
+    """Columnar detection event store backed by fixed-dtype .npy chunks.
+
+    Events are appended into preallocated column buffers and written out
+    every chunk_rows rows as one folder of .npy files (one per column).
+    manifest.json lists the chunks with their row count and time range.
+    Queries memory-map one chunk at a time and skip chunks outside the
+    requested time window, so the dataset never has to fit in memory.
+    """
+
+    def __init__(self, path, roi_names=None, class_names=None, start_time=0.0, chunk_rows=65536):
+        self.path = path
+        self.start_time = float(start_time or 0.0)
+        self.chunk_rows = int(chunk_rows)
+        self.manifest_file = os.path.join(path, "manifest.json")
+
+        if os.path.exists(self.manifest_file):
+            with open(self.manifest_file) as f:
+                self.manifest = json.load(f)
+        else:
+            if roi_names is None:
+                raise FileNotFoundError(f"No event store at '{path}'")
+            self.manifest = {
+                "roi_names": list(roi_names),
+                "class_names": {str(k): v for k, v in (class_names or {}).items()},
+                "columns": {name: [np.dtype(dtype).str, list(shape)] for name, (dtype, shape) in COLUMNS.items()},
+                "chunks": [],
+            }
+
+        self.roi_names = self.manifest["roi_names"]
+        self.roi_id_maps = {}
+        if roi_names is not None:
+            self.roi_ids(roi_names)
+        self.buffers = None
+        self.rows = 0
+
+    # --- ingest ---
+
+    def _allocate(self):
+        self.buffers = {name: np.empty((self.chunk_rows,) + shape, dtype)
+                        for name, (dtype, shape) in COLUMNS.items()}
+        self.rows = 0
+
+    def roi_ids(self, names):
+        """Store-wide ROI ids for a list of ROI names.
+
+        ROIs are identified by name, so a reloaded or edited ROI set keeps
+        the ids of the ROIs it shares with earlier runs; new names are added.
+        """
+        key = tuple(names)
+        ids = self.roi_id_maps.get(key)
+        if ids is None:
+            for name in names:
+                if name not in self.roi_names:
+                    self.roi_names.append(name)
+            ids = self.roi_id_maps[key] = np.array([self.roi_names.index(n) for n in names], np.int16)
+        return ids
+
+    def append(self, packet, roi_index):
+        """Append the filtered detections of one frame packet (vectorized)."""
+        dets = packet.detections
+        if dets is None or len(dets) == 0:
+            return
+        if packet.scale is not None:
+            dets = dets.scaled(*packet.scale)  # store boxes in source-video pixels
+        det_idx, roi_pos = np.nonzero(roi_index.membership(dets.roi_bits))
+        roi_ids = self.roi_ids(roi_index.names)[roi_pos]
+        track_ids = dets.track_ids[det_idx] if dets.track_ids is not None else -1
+        timestamp = self.start_time + packet.timestamp_ms / 1000.0
+        self.append_columns(packet.index, timestamp, roi_ids, dets.cls[det_idx],
+                            dets.conf[det_idx], dets.xyxy[det_idx], track_ids)
+
+    def append_columns(self, frame, timestamp, roi_id, class_id, conf, box, track_id=-1):
+        """Append events given as arrays (scalars are broadcast)."""
+        n = len(roi_id)
+        columns = {"frame": frame, "timestamp": timestamp, "roi_id": roi_id, "class_id": class_id,
+                   "conf": conf, "box": box, "track_id": track_id}
+        start = 0
+        while start < n:
+            if self.buffers is None:
+                self._allocate()
+            take = min(n - start, self.chunk_rows - self.rows)
+            for name, values in columns.items():
+                if np.ndim(values) == 0:
+                    self.buffers[name][self.rows:self.rows + take] = values
+                else:
+                    self.buffers[name][self.rows:self.rows + take] = values[start:start + take]
+            self.rows += take
+            start += take
+            if self.rows == self.chunk_rows:
+                self.flush()
+
+    def flush(self):
+        """Write buffered events as a new chunk."""
+        if self.buffers is None or self.rows == 0:
+            return
+        chunk_id = len(self.manifest["chunks"]) + 1
+        name = f"{chunk_id:06d}"
+        chunk_dir = os.path.join(self.path, "chunks", name)
+        tmp_dir = chunk_dir + ".tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        for column, buffer in self.buffers.items():
+            np.save(os.path.join(tmp_dir, column + ".npy"), buffer[:self.rows])
+        os.replace(tmp_dir, chunk_dir)
+
+        timestamps = self.buffers["timestamp"][:self.rows]
+        self.manifest["chunks"].append({"name": name, "rows": self.rows,
+                                        "t_min": float(timestamps.min()), "t_max": float(timestamps.max())})
+        self._write_manifest()
+        self.rows = 0
+
+    def _write_manifest(self):
+        os.makedirs(self.path, exist_ok=True)
+        tmp_file = self.manifest_file + ".tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(tmp_file, self.manifest_file)
+
+    def close(self):
+        self.flush()
+        if not os.path.exists(self.manifest_file):
+            self._write_manifest()
+
+    # --- queries ---
+
+    @property
+    def total_rows(self):
+        return sum(chunk["rows"] for chunk in self.manifest["chunks"])
+
+    def time_range(self):
+        chunks = self.manifest["chunks"]
+        if not chunks:
+            return None
+        return min(c["t_min"] for c in chunks), max(c["t_max"] for c in chunks)
+
+    def iter_chunks(self, columns, start=None, end=None):
+        """Yield {column: memory-mapped array} per chunk, restricted to start <= t < end."""
+        for chunk in self.manifest["chunks"]:
+            if start is not None and chunk["t_max"] < start:
+                continue
+            if end is not None and chunk["t_min"] >= end:
+                continue
+            chunk_dir = os.path.join(self.path, "chunks", chunk["name"])
+            wanted = set(columns) | {"timestamp"}
+            data = {c: np.load(os.path.join(chunk_dir, c + ".npy"), mmap_mode="r") for c in wanted}
+            if start is not None or end is not None:
+                t = data["timestamp"]
+                mask = np.ones(t.shape[0], bool)
+                if start is not None:
+                    mask &= t >= start
+                if end is not None:
+                    mask &= t < end
+                data = {c: v[mask] for c, v in data.items()}
+            yield data
+
+    def _num_classes(self):
+        names = self.manifest.get("class_names", {})
+        return max([int(k) for k in names] + [0]) + 1
+
+    def counts(self, bucket_seconds=60.0, start=None, end=None, roi=None, class_ids=None):
+        """Event counts per (time bucket, ROI, class).
+
+        Returns (bucket_starts, counts) where counts has shape
+        (num_buckets, num_rois, num_classes). roi (name or id) and class_ids
+        narrow the events that are counted.
+        """
+        time_range = self.time_range()
+        num_rois = len(self.roi_names)
+        num_classes = self._num_classes()
+        if time_range is None:
+            return np.zeros(0), np.zeros((0, num_rois, num_classes), np.int64)
+        t0 = start if start is not None else time_range[0]
+        t1 = end if end is not None else time_range[1] + 1e-9
+        t0 = np.floor(t0 / bucket_seconds) * bucket_seconds
+        num_buckets = max(1, int(np.ceil((t1 - t0) / bucket_seconds)))
+        roi_id = self.roi_names.index(roi) if isinstance(roi, str) else roi
+
+        counts = np.zeros(num_buckets * num_rois * num_classes, np.int64)
+        for data in self.iter_chunks(("roi_id", "class_id"), t0, t1):
+            mask = np.ones(data["timestamp"].shape[0], bool)
+            if roi_id is not None:
+                mask &= data["roi_id"] == roi_id
+            if class_ids is not None:
+                mask &= np.isin(data["class_id"], class_ids)
+            bucket = ((data["timestamp"][mask] - t0) // bucket_seconds).astype(np.int64)
+            cls = np.minimum(data["class_id"][mask].astype(np.int64), num_classes - 1)
+            flat = (bucket * num_rois + data["roi_id"][mask]) * num_classes + cls
+            counts += np.bincount(flat, minlength=counts.shape[0])
+
+        bucket_starts = t0 + bucket_seconds * np.arange(num_buckets)
+        return bucket_starts, counts.reshape(num_buckets, num_rois, num_classes)
+
+    def conf_histogram(self, bins=10, start=None, end=None, roi=None, class_ids=None):
+        """Histogram of detection confidences; returns (counts, bin_edges)."""
+        edges = np.linspace(0.0, 1.0, bins + 1)
+        hist = np.zeros(bins, np.int64)
+        roi_id = self.roi_names.index(roi) if isinstance(roi, str) else roi
+        for data in self.iter_chunks(("roi_id", "class_id", "conf"), start, end):
+            mask = np.ones(data["conf"].shape[0], bool)
+            if roi_id is not None:
+                mask &= data["roi_id"] == roi_id
+            if class_ids is not None:
+                mask &= np.isin(data["class_id"], class_ids)
+            hist += np.histogram(data["conf"][mask], edges)[0]
+        return hist, edges
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-ROI detection counts from an event store")
+    parser.add_argument("store", help="Event store folder (event_store_path in main.py)")
+    parser.add_argument("--bucket", type=float, default=60.0, help="Bucket size in seconds")
+    parser.add_argument("--start", type=float, default=None)
+    parser.add_argument("--end", type=float, default=None)
+    args = parser.parse_args()
+
+    try:
+        store = EventStore(args.store)
+    except FileNotFoundError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+
+    bucket_starts, counts = store.counts(args.bucket, args.start, args.end)
+    print(f"{store.total_rows} events in {len(store.manifest['chunks'])} chunk(s)")
+    print("bucket_start\t" + "\t".join(store.roi_names))
+    for t, per_roi in zip(bucket_starts, counts.sum(axis=2)):
+        print(f"{t:.0f}\t" + "\t".join(str(c) for c in per_roi))
+
+
+if __name__ == "__main__":
+    main()
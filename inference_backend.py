@@ -0,0 +1,373 @@
+# Title: Pluggable inference backends - ultralytics (PyTorch) or ONNX Runtime on the CPU
+#
+# A backend is called as backend(frames, imgsz, classes=None, conf=None) and returns one
+# raw Detections per frame in frame pixels; backend.names maps class IDs to names.
+#
+# The ONNX model is exported once from the .pt weights, e.g.
+#   yolo export model=yolov8n.pt format=onnx dynamic=True simplify=True
+# (load_backend does this itself when given export_from and the .onnx file is missing).
+# A model exported with a fixed imgsz always runs at that shape; a dynamic one runs at
+# the smallest stride-aligned shape that fits what it is given (full frame, ROI crop or
+# tile) instead of a padded square.
+#
+#   python inference_backend.py --selftest
+# builds a small ONNX model locally and checks the ONNX Runtime path (letterbox, decoding,
+# NMS) against an independent OpenCV DNN implementation, without any download.
+
+import ast
+import math
+import os
+import shutil
+import sys
+
+import cv2
+import numpy as np
+
+from detection_cache import file_sha1
+from detection_filter import Detections
+
+BACKENDS = ("ultralytics", "onnxruntime")
+
+# Letterbox padding value, as in ultralytics
+PAD_VALUE = 114
+
+
+def fit_input_shape(width, height, imgsz=640, stride=32):
+    """(height, width) of the network input for an image of width x height: the long side
+    becomes imgsz, the short side is rounded up to the model stride."""
+    scale = imgsz / max(width, height)
+    return (int(math.ceil(height * scale / stride)) * stride,
+            int(math.ceil(width * scale / stride)) * stride)
+
+
+def letterbox_params(width, height, input_shape):
+    """(scale, left, top, new_width, new_height) of the ultralytics letterbox transform."""
+    input_h, input_w = input_shape
+    scale = min(input_h / height, input_w / width)
+    new_w, new_h = int(round(width * scale)), int(round(height * scale))
+    left = int(round((input_w - new_w) / 2 - 0.1))
+    top = int(round((input_h - new_h) / 2 - 0.1))
+    return scale, left, top, new_w, new_h
+
+
+def decode_predictions(pred, conf_threshold=0.25, classes=None, iou_threshold=0.7, max_candidates=3000,
+                       max_det=300):
+    """Decode one YOLOv8 output (4 + num_classes, anchors) into Detections in input pixels.
+
+    Each anchor keeps its best class over all classes; anchors below
+    conf_threshold or whose best class is not in classes (if given) are
+    dropped, as in ultralytics, at most max_candidates of the
+    rest (highest first) go through class-aware NMS and at most max_det
+    detections are returned.
+    """
+    scores = pred[4:]
+    cls = scores.argmax(axis=0)
+    conf = scores[cls, np.arange(scores.shape[1])]
+    passed = conf >= conf_threshold
+    if classes is not None:
+        # Filter on the best class; an anchor is never relabelled as a lower-scoring allowed class
+        allowed = np.zeros(scores.shape[0], bool)
+        allowed[[c for c in classes if 0 <= c < scores.shape[0]]] = True
+        passed &= allowed[cls]
+    keep = np.nonzero(passed)[0]
+    if keep.size > max_candidates:
+        keep = keep[np.argsort(-conf[keep], kind="stable")[:max_candidates]]
+
+    cx, cy, w, h = pred[:4, keep]
+    xyxy = np.stack([cx - w / 2, cy - h / 2, cx + w / 2, cy + h / 2], axis=1).astype(np.float32)
+    detections = Detections(xyxy, conf[keep].astype(np.float32), cls[keep].astype(np.int32)).nms(iou_threshold)
+    if len(detections) > max_det:
+        detections = detections.select(np.sort(np.argsort(-detections.conf, kind="stable")[:max_det]))
+    return detections
+
+
+class UltralyticsBackend:
+    """The ultralytics YOLO model (PyTorch), as used so far."""
+
+    name = "ultralytics"
+
+    def __init__(self, model_path, threads=None):
+        from ultralytics import YOLO
+        if threads:
+            import torch
+            torch.set_num_threads(threads)
+        self.model = YOLO(model_path)  # Automatically downloads if not found
+        self.names = self.model.names
+        self.weights_path = getattr(self.model, "ckpt_path", None) or model_path
+
+    def __call__(self, frames, imgsz=640, classes=None, conf=None):
+        options = {}
+        if classes is not None:
+            options["classes"] = classes
+        if conf is not None:
+            options["conf"] = conf
+        return [Detections.from_boxes(r.boxes) for r in self.model(frames, imgsz=imgsz, verbose=False, **options)]
+
+
+class OnnxBackend:
+    """YOLOv8 ONNX model on ONNX Runtime's CPU provider, without PyTorch.
+
+    Frames are letterboxed (same transform as ultralytics) straight into a
+    reused (batch, 3, h, w) float32 input, the raw output is decoded and
+    NMS'd with NumPy (decode_predictions), and boxes are mapped back to
+    frame pixels. threads sets the intra-op thread count (None = all
+    cores). input_shape (height, width) pins the input shape; otherwise a
+    model exported with a fixed shape uses that, and a dynamic model gets
+    fit_input_shape() of the largest image in each call.
+
+    With cache_dir set, the graph ONNX Runtime optimized on the first start
+    is saved there (keyed by model content and ONNX Runtime version) and
+    later starts load it without optimizing again. The optimized graph may
+    be specific to the machine's CPU, so the cache is per host.
+    """
+
+    name = "onnxruntime"
+
+    def __init__(self, model_path, threads=None, input_shape=None, iou_threshold=0.7, cache_dir=None):
+        import onnxruntime as ort
+        if not os.path.isfile(model_path):
+            raise FileNotFoundError(f"ONNX model '{model_path}' not found (export it with "
+                                    f"'yolo export model=yolov8n.pt format=onnx dynamic=True')")
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        options.inter_op_num_threads = 1
+        if threads:
+            options.intra_op_num_threads = int(threads)
+
+        source = model_path
+        optimized_file = None
+        if cache_dir:
+            digest = file_sha1(model_path, cache_dir)
+            optimized_file = os.path.join(cache_dir, f"{digest}_ort{ort.__version__}.onnx")
+            if os.path.isfile(optimized_file):
+                source = optimized_file
+                options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_DISABLE_ALL
+            else:
+                os.makedirs(cache_dir, exist_ok=True)
+                # Per-process name: several workers may optimize at once
+                options.optimized_model_filepath = f"{optimized_file}.{os.getpid()}.tmp.onnx"
+                # The cache is per host already; skip the "hardware specific" warning
+                options.log_severity_level = 3
+        self.session = ort.InferenceSession(source, options, providers=["CPUExecutionProvider"])
+        if optimized_file and source == model_path and os.path.isfile(options.optimized_model_filepath):
+            os.replace(options.optimized_model_filepath, optimized_file)
+        self.weights_path = model_path
+        self.iou_threshold = iou_threshold
+
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        dims = model_input.shape
+        self.fixed_batch = dims[0] if isinstance(dims[0], int) else None
+        self.model_shape = tuple(dims[2:]) if all(isinstance(d, int) for d in dims[2:]) else None
+        self.input_shape = tuple(input_shape) if input_shape else self.model_shape
+        self.names = self._read_names()
+        self.blob = None
+
+    def _read_names(self):
+        names = self.session.get_modelmeta().custom_metadata_map.get("names")
+        if names:
+            try:
+                return {int(k): v for k, v in ast.literal_eval(names).items()}
+            except (ValueError, SyntaxError):
+                pass
+        num_classes = self.session.get_outputs()[0].shape[1]
+        count = num_classes - 4 if isinstance(num_classes, int) else 80
+        return {i: str(i) for i in range(count)}
+
+    def _input_blob(self, count, shape):
+        # Reused between calls of the same batch size and shape
+        if self.blob is None or self.blob.shape != (count, 3) + shape:
+            self.blob = np.empty((count, 3) + shape, np.float32)
+        return self.blob
+
+    def preprocess(self, frames, imgsz=640):
+        """Letterbox BGR frames into one normalized RGB NCHW blob; returns (blob, params)."""
+        shape = self.input_shape
+        if shape is None:
+            shape = max((fit_input_shape(f.shape[1], f.shape[0], imgsz) for f in frames),
+                        key=lambda s: s[0] * s[1])
+        blob = self._input_blob(len(frames), shape)
+        blob.fill(PAD_VALUE / 255.0)
+        params = []
+        for i, frame in enumerate(frames):
+            height, width = frame.shape[:2]
+            scale, left, top, new_w, new_h = letterbox_params(width, height, shape)
+            resized = frame
+            if (new_w, new_h) != (width, height):
+                resized = cv2.resize(frame, (new_w, new_h), interpolation=cv2.INTER_LINEAR)
+            # BGR HWC uint8 -> RGB CHW float in [0, 1], written straight into the blob
+            np.multiply(resized[..., ::-1].transpose(2, 0, 1), 1.0 / 255.0,
+                        out=blob[i, :, top:top + new_h, left:left + new_w], casting="unsafe")
+            params.append((scale, left, top, width, height))
+        return blob, params
+
+    def _run(self, blob):
+        if self.fixed_batch is None or self.fixed_batch == blob.shape[0]:
+            return self.session.run(None, {self.input_name: blob})[0]
+        # Fixed-batch export: run the images one at a time
+        return np.concatenate([self.session.run(None, {self.input_name: blob[i:i + 1]})[0]
+                               for i in range(blob.shape[0])])
+
+    def __call__(self, frames, imgsz=640, classes=None, conf=None):
+        if not frames:
+            return []
+        blob, params = self.preprocess(frames, imgsz)
+        output = self._run(blob)
+        results = []
+        for pred, (scale, left, top, width, height) in zip(output, params):
+            detections = decode_predictions(pred, 0.25 if conf is None else conf, classes, self.iou_threshold)
+            xyxy = (detections.xyxy - np.array([left, top, left, top], np.float32)) / scale
+            np.clip(xyxy[:, 0::2], 0, width, out=xyxy[:, 0::2])
+            np.clip(xyxy[:, 1::2], 0, height, out=xyxy[:, 1::2])
+            results.append(Detections(xyxy, detections.conf, detections.cls))
+        return results
+
+
+def export_onnx(weights_path, onnx_path, imgsz=640):
+    """Export ultralytics weights to onnx_path (dynamic shapes); needs ultralytics once."""
+    from ultralytics import YOLO
+    exported = YOLO(weights_path).export(format="onnx", dynamic=True, imgsz=imgsz)
+    if os.path.abspath(exported) != os.path.abspath(onnx_path):
+        os.makedirs(os.path.dirname(onnx_path) or ".", exist_ok=True)
+        shutil.move(exported, onnx_path)
+    return onnx_path
+
+
+def load_backend(name, model_path, threads=None, input_shape=None, cache_dir=None, export_from=None):
+    """Create the named backend ("ultralytics" or "onnxruntime").
+
+    For onnxruntime, a missing model_path is exported from the export_from
+    weights first (once; later starts load the file), and cache_dir keeps
+    the optimized graph between starts.
+    """
+    if name == "ultralytics":
+        return UltralyticsBackend(model_path, threads)
+    if name == "onnxruntime":
+        if export_from and not os.path.isfile(model_path):
+            print(f"Exporting '{export_from}' to '{model_path}' (first start only)")
+            export_onnx(export_from, model_path)
+        return OnnxBackend(model_path, threads, input_shape, cache_dir=cache_dir)
+    raise ValueError(f"Unknown inference backend '{name}' (expected one of {', '.join(BACKENDS)})")
+
+
+# --- SELF-TEST ---
+
+def _build_test_model(path, input_shape=(256, 320), num_classes=6, seed=0):
+    """A tiny YOLOv8-shaped ONNX model: a stride-32 convolution whose output is decoded as
+    (cx, cy, w, h, class scores) per grid cell, like the real detection head."""
+    import onnx
+    from onnx import TensorProto, helper, numpy_helper
+
+    rng = np.random.default_rng(seed)
+    height, width = input_shape
+    rows, cols = height // 32, width // 32
+    channels = 4 + num_classes
+    weight = rng.normal(0, 0.02, (channels, 3, 32, 32)).astype(np.float32)
+    gy, gx = np.mgrid[0:rows, 0:cols]
+    grid = np.zeros((1, channels, rows * cols), np.float32)
+    grid[0, 0] = (gx.ravel() + 0.5) * 32
+    grid[0, 1] = (gy.ravel() + 0.5) * 32
+    grid[0, 2:4] = 160.0  # neighbouring cells overlap, so NMS has work to do
+    box_scale = np.array([16, 16, 20, 20] + [4] * num_classes, np.float32).reshape(1, channels, 1)
+    is_box = np.array([1, 1, 1, 1] + [0] * num_classes, np.float32).reshape(1, channels, 1)
+
+    nodes = [
+        helper.make_node("Conv", ["images", "weight"], ["conv"], kernel_shape=[32, 32], strides=[32, 32]),
+        helper.make_node("Reshape", ["conv", "flat_shape"], ["flat"]),
+        helper.make_node("Mul", ["flat", "box_scale"], ["scaled"]),
+        helper.make_node("Sigmoid", ["scaled"], ["prob"]),
+        # Box channels: scaled + grid; class channels: sigmoid
+        helper.make_node("Add", ["scaled", "grid"], ["boxes"]),
+        helper.make_node("Mul", ["boxes", "is_box"], ["box_part"]),
+        helper.make_node("Sub", ["one", "is_box"], ["is_class"]),
+        helper.make_node("Mul", ["prob", "is_class"], ["class_part"]),
+        helper.make_node("Add", ["box_part", "class_part"], ["output0"]),
+    ]
+    initializers = [
+        numpy_helper.from_array(weight, "weight"),
+        numpy_helper.from_array(np.array([0, channels, rows * cols], np.int64), "flat_shape"),
+        numpy_helper.from_array(box_scale, "box_scale"),
+        numpy_helper.from_array(grid, "grid"),
+        numpy_helper.from_array(is_box, "is_box"),
+        numpy_helper.from_array(np.ones((1, 1, 1), np.float32), "one"),
+    ]
+    graph = helper.make_graph(
+        nodes, "yolo_selftest",
+        [helper.make_tensor_value_info("images", TensorProto.FLOAT, ["batch", 3, height, width])],
+        [helper.make_tensor_value_info("output0", TensorProto.FLOAT, ["batch", channels, rows * cols])],
+        initializers)
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", 13)])
+    model.ir_version = 8
+    names = {i: f"class{i}" for i in range(num_classes)}
+    model.metadata_props.append(onnx.StringStringEntryProto(key="names", value=repr(names)))
+    onnx.save(model, path)
+
+
+def _reference_detections(path, frame, input_shape, conf_threshold, iou_threshold, classes=None):
+    """The same pipeline written independently: copyMakeBorder letterbox, OpenCV DNN,
+    per-anchor decoding (best class, then the classes filter) and cv2.dnn.NMSBoxesBatched."""
+    net = cv2.dnn.readNetFromONNX(path)
+    height, width = frame.shape[:2]
+    scale = min(input_shape[0] / height, input_shape[1] / width)
+    new_w, new_h = int(round(width * scale)), int(round(height * scale))
+    dw, dh = (input_shape[1] - new_w) / 2, (input_shape[0] - new_h) / 2
+    top, bottom = int(round(dh - 0.1)), int(round(dh + 0.1))
+    left, right = int(round(dw - 0.1)), int(round(dw + 0.1))
+    image = cv2.resize(frame, (new_w, new_h), interpolation=cv2.INTER_LINEAR)
+    image = cv2.copyMakeBorder(image, top, bottom, left, right, cv2.BORDER_CONSTANT, value=(PAD_VALUE,) * 3)
+    net.setInput(cv2.dnn.blobFromImage(image, 1 / 255.0, swapRB=True))
+    pred = net.forward()[0]
+
+    boxes, scores, labels = [], [], []
+    for anchor in range(pred.shape[1]):
+        cx, cy, w, h = pred[:4, anchor]
+        class_scores = pred[4:, anchor]
+        c = int(np.argmax(class_scores))
+        if class_scores[c] >= conf_threshold and (classes is None or c in classes):
+            boxes.append([float(cx - w / 2), float(cy - h / 2), float(w), float(h)])
+            scores.append(float(class_scores[c]))
+            labels.append(c)
+    keep = cv2.dnn.NMSBoxesBatched(boxes, scores, labels, conf_threshold, iou_threshold) if boxes else []
+    result = []
+    for i in np.array(keep).reshape(-1).tolist():
+        x, y, w, h = boxes[i]
+        x1, y1 = (x - left) / scale, (y - top) / scale
+        x2, y2 = (x + w - left) / scale, (y + h - top) / scale
+        result.append((labels[i], scores[i], min(max(x1, 0), width), min(max(y1, 0), height),
+                       min(max(x2, 0), width), min(max(y2, 0), height)))
+    return sorted(result)
+
+
+def selftest():
+    import tempfile
+    rng = np.random.default_rng(1)
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "selftest.onnx")
+        _build_test_model(path)
+        backend = OnnxBackend(path, threads=1)
+        frames = [rng.integers(0, 256, (360, 640, 3), np.uint8), rng.integers(0, 256, (480, 400, 3), np.uint8),
+                  cv2.GaussianBlur(rng.integers(0, 256, (720, 1280, 3), np.uint8), (31, 31), 0)]
+        failures = 0
+        # The classes case drops anchors whose best class is not allowed (never relabels them)
+        for conf, classes in ((0.5, None), (0.85, None), (0.5, [0, 2])):
+            results = backend(frames, conf=conf, classes=classes)
+            for i, (frame, detections) in enumerate(zip(frames, results)):
+                expected = _reference_detections(path, frame, backend.input_shape, conf, backend.iou_threshold,
+                                                 classes)
+                got = sorted(zip(detections.cls.tolist(), detections.conf.tolist(),
+                                 *detections.xyxy.T.tolist()))
+                same = (len(got) == len(expected) and
+                        all(g[0] == e[0] and np.allclose(g[1:], e[1:], atol=1e-2) for g, e in zip(got, expected)))
+                failures += not same
+                print(f"conf {conf}{f' classes {classes}' if classes else ''} "
+                      f"frame {i} ({frame.shape[1]}x{frame.shape[0]}): "
+                      f"{len(got)} vs {len(expected)} detections - {'OK' if same else 'MISMATCH'}")
+    print("Self-test passed" if failures == 0 else f"Self-test FAILED ({failures} mismatches)")
+    return failures == 0
+
+
+if __name__ == "__main__":
+    if "--selftest" in sys.argv[1:]:
+        sys.exit(0 if selftest() else 1)
+    print("Usage: python inference_backend.py --selftest")
@@ -0,0 +1,279 @@
+# Title: Per-stage latency instrumentation and cProfile hooks for the detection pipeline
+
+import cProfile
+import io
+import json
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+
+import numpy as np
+
+QUANTILES = (50, 95, 99)
+
+
+class StageTimer:
+    """Rolling per-stage latency statistics for the frame pipeline.
+
+    Stages call record(stage, seconds) with durations measured by
+    time.perf_counter(); the sink calls frame_done() once per output frame.
+    Every report_interval seconds p50/p95/p99 per stage and the output FPS
+    are printed, appended as one JSON line to jsonl_path and written as a
+    Prometheus text file to prometheus_path (both optional).
+
+    When profile_frames > 0, every stage thread is run under cProfile for
+    frames profile_start .. profile_start + profile_frames - 1, and the
+    merged stats are written to profile_path.
+
+    Pipelines take timer=None when instrumentation is off, so the disabled
+    cost is a single None check per stage.
+    """
+
+    def __init__(self, window=1000, report_interval=10.0, jsonl_path=None, prometheus_path=None,
+                 profile_start=1, profile_frames=0, profile_path="pipeline.prof"):
+        self.window = int(window)
+        self.report_interval = report_interval
+        self.jsonl_path = jsonl_path
+        self.prometheus_path = prometheus_path
+
+        self.samples = {}
+        self.counts = {}
+        self.lock = threading.Lock()
+
+        self.started = time.monotonic()
+        self.last_report = self.started
+        self.frames = 0
+        self.frames_at_last_report = 0
+
+        self.profile_start = profile_start
+        self.profile_end = profile_start + profile_frames
+        self.profile_path = profile_path
+        self.profilers = []
+        self.profile_dumped = profile_frames <= 0
+        self.local = threading.local()
+
+    def record(self, stage, seconds):
+        with self.lock:
+            ring = self.samples.get(stage)
+            if ring is None:
+                ring = self.samples[stage] = np.zeros(self.window, np.float64)
+                self.counts[stage] = 0
+            ring[self.counts[stage] % self.window] = seconds
+            self.counts[stage] += 1
+
+    def percentiles(self):
+        """Return {stage: {"p50": s, "p95": s, "p99": s, "count": n}} over the rolling window."""
+        with self.lock:
+            stats = {}
+            for stage, ring in self.samples.items():
+                count = self.counts[stage]
+                values = ring[:min(count, self.window)]
+                pct = np.percentile(values, QUANTILES)
+                stats[stage] = {f"p{q}": float(v) for q, v in zip(QUANTILES, pct)}
+                stats[stage]["count"] = count
+            return stats
+
+    def frame_done(self, index):
+        self.frames += 1
+        if not self.profile_dumped and index >= self.profile_end - 1:
+            self.dump_profile()
+
+        now = time.monotonic()
+        if now - self.last_report >= self.report_interval:
+            self.report(now)
+
+    def report(self, now=None):
+        now = now if now is not None else time.monotonic()
+        elapsed = now - self.last_report
+        fps = (self.frames - self.frames_at_last_report) / elapsed if elapsed > 0 else 0.0
+        self.last_report = now
+        self.frames_at_last_report = self.frames
+        stats = self.percentiles()
+
+        lines = [f"--- Stage latency (ms) after {self.frames} frames, {fps:.1f} FPS ---"]
+        for stage, s in stats.items():
+            lines.append(f"  {stage:<12} p50 {s['p50'] * 1000:7.2f}  p95 {s['p95'] * 1000:7.2f}  "
+                         f"p99 {s['p99'] * 1000:7.2f}  (n={s['count']})")
+        print("\n".join(lines))
+
+        if self.jsonl_path:
+            with open(self.jsonl_path, "a") as f:
+                f.write(json.dumps({"time": time.time(), "frames": self.frames,
+                                    "fps": round(fps, 3), "stages": stats}) + "\n")
+        if self.prometheus_path:
+            self._write_prometheus(stats, fps)
+
+    def _write_prometheus(self, stats, fps):
+        out = ["# HELP pipeline_stage_latency_seconds Per-frame latency of each pipeline stage",
+               "# TYPE pipeline_stage_latency_seconds summary"]
+        for stage, s in stats.items():
+            for q in QUANTILES:
+                out.append(f'pipeline_stage_latency_seconds{{stage="{stage}",quantile="{q / 100}"}} '
+                           f'{s[f"p{q}"]:.6f}')
+            out.append(f'pipeline_stage_latency_seconds_count{{stage="{stage}"}} {s["count"]}')
+        out += ["# HELP pipeline_fps Frames per second leaving the pipeline",
+                "# TYPE pipeline_fps gauge",
+                f"pipeline_fps {fps:.3f}",
+                "# TYPE pipeline_frames_total counter",
+                f"pipeline_frames_total {self.frames}"]
+
+        # Write-then-rename so a scraper never sees a half-written file
+        tmp_path = self.prometheus_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write("\n".join(out) + "\n")
+        os.replace(tmp_path, self.prometheus_path)
+
+    # --- cProfile window ---
+
+    def profile_enter(self, index):
+        """Start profiling the calling thread if index is inside the profile window."""
+        if self.profile_dumped or not self.profile_start <= index < self.profile_end:
+            return
+        profiler = getattr(self.local, "profiler", None)
+        if profiler is None:
+            profiler = self.local.profiler = cProfile.Profile()
+            with self.lock:
+                self.profilers.append(profiler)
+        profiler.enable()
+        self.local.active = True
+
+    def profile_exit(self):
+        if getattr(self.local, "active", False):
+            self.local.profiler.disable()
+            self.local.active = False
+
+    def dump_profile(self):
+        self.profile_dumped = True
+        with self.lock:
+            profilers = list(self.profilers)
+        if not profilers:
+            return
+        stats = None
+        for profiler in profilers:
+            try:
+                if stats is None:
+                    stats = pstats.Stats(profiler)
+                else:
+                    stats.add(profiler)
+            except TypeError:
+                # A thread that never finished a profiled frame has no stats yet
+                continue
+        if stats is None:
+            return
+        stats.dump_stats(self.profile_path)
+
+        summary = io.StringIO()
+        stats.stream = summary
+        stats.sort_stats("cumulative").print_stats(15)
+        print(f"Profile of frames {self.profile_start}-{self.profile_end - 1} saved to {self.profile_path}")
+        print(summary.getvalue())
+
+
+class StartupTimer:
+    """Wall-clock time of each startup phase, up to the first processed frame.
+
+    mark(phase) closes the phase that ran since the previous mark;
+    first_frame() closes the last one, prints the breakdown and appends it
+    as one JSON line to jsonl_path (optional), so restart times can be
+    compared across runs and configuration changes.
+    """
+
+    def __init__(self, started=None, jsonl_path=None):
+        self.started = started if started is not None else time.perf_counter()
+        self.last = self.started
+        self.phases = {}
+        self.jsonl_path = jsonl_path
+        self.reported = False
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.phases[phase] = self.phases.get(phase, 0.0) + now - self.last
+        self.last = now
+
+    def first_frame(self):
+        if self.reported:
+            return
+        self.reported = True
+        self.mark("first frame")
+        total = self.last - self.started
+        print("Startup: " + ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in self.phases.items())
+              + f" -> first frame processed {total:.2f}s after start")
+        if self.jsonl_path:
+            with open(self.jsonl_path, "a") as f:
+                f.write(json.dumps({"time": time.time(), "seconds": round(total, 4),
+                                    "phases": {k: round(v, 4) for k, v in self.phases.items()}}) + "\n")
+
+
+class AllocationMonitor:
+    """tracemalloc-based allocation report for the frame loop (debug only).
+
+    The sink calls frame_done() once per output frame. Every report_interval
+    frames it prints, per frame: the blocks and bytes allocated and still
+    alive (retained growth - about zero in steady state, anything else is a
+    leak or an unbounded cache), the transient peak above the level at the
+    previous frame (short-lived buffers of frames in flight), and the source
+    lines that retained the most. Python objects as well as NumPy / OpenCV
+    arrays are traced, but only in this process.
+
+    Tracing makes every allocation slower, so this is a debug switch only.
+    """
+
+    def __init__(self, report_interval=300, top_sites=5):
+        self.report_interval = max(1, int(report_interval))
+        self.top_sites = top_sites
+        self.filters = [tracemalloc.Filter(False, tracemalloc.__file__),
+                        tracemalloc.Filter(False, "<frozen importlib._bootstrap>")]
+        tracemalloc.start()
+        self.snapshot = tracemalloc.take_snapshot().filter_traces(self.filters)
+        self.frames = 0
+        self.frames_at_last_report = 0
+        self._reset_window()
+
+    def _reset_window(self):
+        tracemalloc.reset_peak()
+        self.baseline = tracemalloc.get_traced_memory()[0]
+        self.transient_total = 0
+        self.transient_max = 0
+
+    def frame_done(self):
+        current, peak = tracemalloc.get_traced_memory()
+        transient = max(0, peak - self.baseline)
+        self.transient_total += transient
+        self.transient_max = max(self.transient_max, transient)
+        tracemalloc.reset_peak()
+        self.baseline = current
+
+        self.frames += 1
+        if self.frames - self.frames_at_last_report >= self.report_interval:
+            self.report()
+
+    def report(self):
+        frames = self.frames - self.frames_at_last_report
+        if frames == 0 or not tracemalloc.is_tracing():
+            return
+        snapshot = tracemalloc.take_snapshot().filter_traces(self.filters)
+        stats = snapshot.compare_to(self.snapshot, "lineno")
+        blocks = sum(s.count_diff for s in stats)
+        size = sum(s.size_diff for s in stats)
+        current = tracemalloc.get_traced_memory()[0]
+
+        lines = [f"--- Allocations per frame over frames {self.frames_at_last_report + 1}-{self.frames} ---",
+                 f"  retained   {blocks / frames:+10.2f} blocks  {size / frames:+12,.0f} bytes",
+                 f"  transient  {self.transient_total / frames:12,.0f} bytes mean  "
+                 f"{self.transient_max:12,.0f} bytes max",
+                 f"  traced     {current / 1e6:10.1f} MB live"]
+        growing = sorted((s for s in stats if s.size_diff > 0), key=lambda s: s.size_diff, reverse=True)
+        for s in growing[:self.top_sites]:
+            lines.append(f"  {s.size_diff / frames:+12,.0f} bytes/frame  {s.traceback}")
+        print("\n".join(lines))
+
+        self.snapshot = snapshot
+        self.frames_at_last_report = self.frames
+        self._reset_window()
+
+    def stop(self):
+        self.report()
+        self.snapshot = None
+        tracemalloc.stop()
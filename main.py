@@ -1,16 +1,189 @@
 # Title: YOLOv8 Object Detection with Region and Class Filtering on Video
 
-from ultralytics import YOLO
+import time
+
+# Startup is timed from here to the first processed frame (see startup_report_path)
+startup_started = time.perf_counter()
+
 import cv2
 import numpy as np
 import os
 import sys
 
+from detection_cache import DetectionCache, cache_key, file_sha1
+from detection_filter import DetectionFilter, draw_detections
+from motion_gate import MotionGate, MotionGatedDetector
+from inference_backend import export_onnx, load_backend
+from instrumentation import AllocationMonitor, StageTimer, StartupTimer
+from outputs import JsonlDetectionWriter, VideoWriterThread
+from pipeline import FramePipeline, full_frame_imgsz, processing_size, stride_for_fps
+from roi_crop import CroppedDetector, crop_inference_size, roi_crop_rects
+from roi_config import ROIConfigWatcher
+from roi_overlay import ROIOverlay
+from roi_rules import load_roi_rules, rules_path_for
+from roi_tiles import TiledDetector, roi_tile_rects
+from tracker import IoUTracker, TrackedDetector
+
 # --- CONFIGURATION ---
 
 # COCO class IDs to keep (e.g., 1=person, 2=bicycle, 3=car, 5=bus, 7=truck, 9=traffic light)
 allowed_class_ids = [1, 2, 3, 5, 7, 9]
 
+# Minimum confidence for a detection to be kept (0.25 is also YOLOv8's own default)
+conf_threshold = 0.25
+
+# Per-ROI class / confidence rules (see roi_rules.py for the format). None = the
+# roi_rules.json next to roi_config_path, if there is one; without rules every ROI
+# uses allowed_class_ids and conf_threshold above.
+roi_rules_path = None
+
+# Pass the union of allowed classes and the lowest threshold into the model call, so
+# classes that no ROI keeps are dropped before NMS. While the detection cache is in use the
+# model keeps every class instead, at detection_cache_min_conf (or the lowest threshold if
+# lower), so classes can be tuned against the cached detections.
+model_class_filter = True
+
+# Bounded queue depths between the decode -> inference -> post-process -> display stages
+decode_queue_size = 4
+inference_queue_size = 4
+postprocess_queue_size = 4
+
+# Decode into a fixed pool of preallocated frame buffers that are recycled once a frame has
+# been displayed / written, instead of allocating a new frame for every frame read
+reuse_frame_buffers = True
+
+# Frame stride: analyze only every Nth frame (skipped frames are grabbed, not decoded to
+# images). analysis_fps, if set, derives the stride from the video FPS instead.
+frame_stride = 1
+analysis_fps = None
+
+# Downscaled processing: frames are resized to this width (aspect kept) right after decoding,
+# and inference, filtering, drawing and the video output run at that size. ROIs are rescaled
+# automatically; JSONL / event store boxes stay in source-video pixels. None = full resolution.
+processing_width = None
+
+# Micro-batching: run one model call on up to this many frames, waiting at most
+# inference_batch_wait_ms for a batch to fill. Raise both for offline throughput,
+# keep batch size 1 for the lowest latency on live feeds.
+inference_batch_size = 1
+inference_batch_wait_ms = 0
+
+# Multi-process mode: this process decodes frames into a shared-memory ring of
+# process_ring_slots frames (None = sized automatically) and process_workers worker
+# processes run inference, filtering and drawing on them in place. 0 = threads in one process.
+# Tracking, motion gating, the detection cache, instrumentation and ROI hot reload
+# need a single process and are turned off in this mode.
+process_workers = 0
+process_ring_slots = None
+
+# Model input size for full-frame inference (lowered to the processing size when frames are smaller)
+model_imgsz = 640
+
+# ROI-cropped inference: only feed the (padded, merged) bounding rects of the
+# ROI polygons to the model instead of the full frame
+roi_crop_inference = False
+roi_crop_padding = 16
+roi_crop_merge_gap = 32
+
+# Tiled inference for small, distant objects: the model runs on square tiles laid only over
+# the ROIs, from tile_far_size px at the top of the ROIs (far from the camera) growing to
+# tile_near_size px at their bottom, all resized to tile_imgsz in one batch. tile_full_frame
+# adds a full-frame pass for objects larger than a tile; duplicates are merged with NMS at
+# tile_nms_iou. Takes the place of roi_crop_inference when both are set.
+tiled_inference = False
+tile_far_size = 160
+tile_near_size = 320
+tile_overlap = 0.25
+tile_imgsz = 320
+tile_full_frame = True
+tile_nms_iou = 0.5
+
+# Motion gating: skip inference (reusing the last detections) when nothing changed
+# inside the ROIs, with a forced refresh every motion_refresh_interval frames
+motion_gating = False
+motion_downscale = 4
+motion_pixel_threshold = 25
+motion_min_changed_fraction = 0.002
+motion_refresh_interval = 30
+
+# Tracking: run the detector only every track_detect_interval frames (sooner when the
+# mean track confidence drops below track_refresh_confidence) and propagate tracks in
+# between. Tracks get stable IDs and per-ROI occupancy is reported on every frame.
+tracking = False
+track_detect_interval = 5
+track_refresh_confidence = 0.3
+track_iou_threshold = 0.3
+track_max_age = 15
+
+# YOLOv8 weights (downloaded automatically if not found)
+model_path = 'yolov8n.pt'
+
+# Inference backend: "ultralytics" (PyTorch, model_path) or "onnxruntime" (CPU only, no
+# PyTorch, onnx_model_path - export it once with
+# `yolo export model=yolov8n.pt format=onnx dynamic=True`)
+inference_backend = "ultralytics"
+onnx_model_path = 'yolov8n.onnx'
+# Intra-op threads of the inference backend (None = the runtime's default)
+inference_threads = None
+# Fixed (height, width) onnxruntime input; None = the smallest shape that fits each region the
+# model sees (full frame, ROI crop or tile) at its imgsz, instead of a padded square
+onnx_input_shape = None
+
+# Startup: warm the model up on this many dummy batches at the processing resolution before
+# reading the video, so the first real frame does not pay for lazy initialization (0 = off)
+model_warmup_runs = 1
+# Prepared state reused by later starts: the ONNX export of model_path (made on the first
+# onnxruntime start when onnx_model_path is missing), ONNX Runtime's optimized graph and file
+# hashes. Compiled ROIs are kept in roi_compiled_cache_dir.
+model_cache_dir = "model_cache"
+# Each start's phase timings (to the first processed frame) are printed and, if set, appended
+# here as one JSON line, e.g. "startup.jsonl"
+startup_report_path = None
+
+# Raw detections are cached here per (video content, model weights, inference
+# parameters), so re-runs with different ROIs or classes skip inference entirely.
+# Set to None to disable.
+detection_cache_dir = "detection_cache"
+# Confidence floor of the cached raw detections: the model runs at the lower of this and the
+# lowest ROI rule / conf_threshold, so thresholds can be tuned above it against one cache
+detection_cache_min_conf = 0.25
+
+# ROI set saved by bounding_box_mapper.py (session folder or its roi_polygons.json).
+# The file is watched while running: saving new polygons swaps them in between frames,
+# without restarting or reloading the model. Compiled ROI masks are cached in
+# roi_compiled_cache_dir by file hash (None = no cache).
+roi_config_path = "roi_mapping_results/intersectionRoad1_20250718_165220"
+roi_config_poll_interval = 1.0
+roi_compiled_cache_dir = "roi_cache"
+
+# Opacity of the ROI fill drawn under the outlines (0 = outlines only)
+roi_fill_alpha = 0.0
+
+# Headless mode: no windows (for display-less servers). Results go to the outputs below;
+# frames are only annotated when a video output is requested.
+headless = False
+jsonl_output_path = None   # e.g. "detections.jsonl" - one line of filtered detections per frame
+video_output_path = None   # e.g. "annotated.mp4" - annotated video, encoded on a background thread
+
+# Columnar event store for history queries (counts per ROI / class / minute, see event_store.py).
+# event_store_start_time is the wall-clock time (epoch seconds) of the first video frame.
+event_store_path = None    # e.g. "detection_events"
+event_store_start_time = None
+
+# Per-stage latency instrumentation (decode / inference / filter / draw / output / display):
+# rolling p50/p95/p99 and FPS, reported every instrumentation_report_interval seconds
+instrumentation = False
+instrumentation_report_interval = 10.0
+instrumentation_jsonl_path = None        # e.g. "stage_latency.jsonl"
+instrumentation_prometheus_path = None   # e.g. "stage_latency.prom"
+# Wrap frames profile_start_frame .. profile_start_frame + profile_frames - 1 in cProfile (0 = off)
+profile_start_frame = 100
+profile_frames = 0
+# Debug switch: trace allocations (tracemalloc) and report retained / transient bytes per frame
+# and the top allocating lines every allocation_report_interval frames. Slows the loop down.
+allocation_debug = False
+allocation_report_interval = 300
+
 # Define 2 custom regions (bounding boxes): (x1, y1), (x2, y2)
 # These will be automatically calculated based on video dimensions
 roi1 = None  # Will be set automatically
@@ -19,147 +192,444 @@ roi2 = None  # Will be set automatically
 # Path to video file (downloaded video)
 video_path = "intersectionRoad1.mp4"
 
-# --- ERROR HANDLING & VALIDATION ---
-
-# Check if video file exists
-if not os.path.exists(video_path):
-    print(f"Error: Video file '{video_path}' not found!")
-    print("Please check the file path and make sure the video exists.")
-    sys.exit(1)
-
-# Check if file is readable
-if not os.access(video_path, os.R_OK):
-    print(f"Error: Cannot read video file '{video_path}' - permission denied!")
-    sys.exit(1)
-
-# --- LOAD MODEL ---
-try:
-    model = YOLO('yolov8n.pt')  # Automatically downloads if not found
-    print("YOLOv8 model loaded successfully!")
-except Exception as e:
-    print(f"Error loading YOLOv8 model: {e}")
-    sys.exit(1)
-
-# --- VIDEO CAPTURE ---
-cap = cv2.VideoCapture(video_path)
-
-# Check if video opened successfully
-if not cap.isOpened():
-    print(f"Error: Could not open video file '{video_path}'")
-    print("Possible causes:")
-    print("- File is corrupted")
-    print("- Unsupported video format")
-    print("- File is being used by another application")
-    sys.exit(1)
-
-# Get video info for resizing window
-frame_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-frame_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-fps = cap.get(cv2.CAP_PROP_FPS)
-total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-
-print(f"Video loaded: {frame_width}x{frame_height}, {fps:.2f} FPS, {total_frames} frames")
-
-# ========================================
-# POLYGON ROI CONFIGURATION
-# ========================================
-# road1 polygon points
-road1_points = [(285, 91), (471, 117), (549, 17), (374, 4), (284, 92)]
-road1_polygon = np.array(road1_points, np.int32)
-
-# road2 polygon points
-road2_points = [(512, 157), (438, 310), (626, 345), (635, 187), (514, 158)]
-road2_polygon = np.array(road2_points, np.int32)
-
-# Function to check if point is inside polygon
-def is_inside_polygon(x, y, polygon):
-    return cv2.pointPolygonTest(polygon, (x, y), False) >= 0
-
-print(f"Loaded polygon ROI: road1 ({len(road1_points)} points), road2 ({len(road2_points)} points)")
-
-# ========================================
-# END OF POLYGON ROI CONFIGURATION
-# ========================================
-
-def is_inside_roi(xyxy, roi):
-    x1, y1, x2, y2 = int(xyxy[0]), int(xyxy[1]), int(xyxy[2]), int(xyxy[3])
-    roi_x1, roi_y1 = roi[0]
-    roi_x2, roi_y2 = roi[1]
-    return (x1 >= roi_x1 and y1 >= roi_y1 and x2 <= roi_x2 and y2 <= roi_y2)
-
-print("Starting video processing... Press 'q' to quit")
-
-try:
-    frame_count = 0
-    while cap.isOpened():
-        ret, frame = cap.read()
-        if not ret:
-            print("End of video or failed to read frame")
-            break
-        
-        frame_count += 1
-        
+# Everything below runs only when main.py is executed directly: worker processes of the
+# multi-process mode (spawned, also on Windows) import this file and must stop here.
+if __name__ == "__main__":
+    startup_timer = StartupTimer(startup_started, startup_report_path)
+    startup_timer.mark("imports")
+
+    # --- ERROR HANDLING & VALIDATION ---
+
+    # Check if video file exists
+    if not os.path.exists(video_path):
+        print(f"Error: Video file '{video_path}' not found!")
+        print("Please check the file path and make sure the video exists.")
+        sys.exit(1)
+
+    # Check if file is readable
+    if not os.access(video_path, os.R_OK):
+        print(f"Error: Cannot read video file '{video_path}' - permission denied!")
+        sys.exit(1)
+
+    # --- VIDEO CAPTURE ---
+    cap = cv2.VideoCapture(video_path)
+
+    # Check if video opened successfully
+    if not cap.isOpened():
+        print(f"Error: Could not open video file '{video_path}'")
+        print("Possible causes:")
+        print("- File is corrupted")
+        print("- Unsupported video format")
+        print("- File is being used by another application")
+        sys.exit(1)
+
+    # Get video info for resizing window
+    frame_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    frame_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+
+    print(f"Video loaded: {frame_width}x{frame_height}, {fps:.2f} FPS, {total_frames} frames")
+    startup_timer.mark("video")
+
+    # Frames are downscaled right after decoding; every later stage works at this size
+    process_width, process_height = processing_size(frame_width, frame_height, processing_width)
+    # Inference on downscaled frames runs at their size instead of scaling them back up
+    full_imgsz = full_frame_imgsz(process_width, process_height, model_imgsz)
+    if (process_width, process_height) != (frame_width, frame_height):
+        print(f"Processing at {process_width}x{process_height} (full-frame imgsz {full_imgsz})")
+
+    if analysis_fps:
+        frame_stride = stride_for_fps(fps, analysis_fps)
+    if frame_stride > 1:
+        print(f"Analyzing 1 of every {frame_stride} frames ({fps / frame_stride:.2f} FPS)")
+
+    # ========================================
+    # POLYGON ROI CONFIGURATION
+    # ========================================
+    # Polygons are rasterized once into an ROIIndex; membership checks become a single array lookup
+    try:
+        roi_watcher = ROIConfigWatcher(roi_config_path, process_width, process_height,
+                                       roi_compiled_cache_dir, roi_config_poll_interval)
+    except (OSError, KeyError, ValueError) as e:
+        print(f"Error loading ROIs from '{roi_config_path}': {e}")
+        cap.release()
+        sys.exit(1)
+    roi_index = roi_watcher.current
+
+    # ROI outlines and labels are rendered once and composited onto each frame
+    roi_overlay = ROIOverlay(roi_index.polygons, roi_index.names, fill_alpha=roi_fill_alpha)
+
+    # Per-ROI class / confidence rules + center-in-ROI, applied to a whole frame at once
+    rules_file = roi_rules_path or rules_path_for(roi_config_path)
+    try:
+        roi_rules = load_roi_rules(rules_file)
+    except (OSError, ValueError) as e:
+        print(f"Error loading ROI rules from '{rules_file}': {e}")
+        cap.release()
+        sys.exit(1)
+    if roi_rules is not None:
+        print(f"Loaded ROI rules: {rules_file}")
+    detection_filter = DetectionFilter(roi_index, allowed_class_ids, conf_threshold, roi_rules)
+
+    print("Loaded polygon ROI: " + ", ".join(f"{name} ({len(pts)} points)"
+                                             for name, pts in zip(roi_index.names, roi_index.polygons)))
+    startup_timer.mark("rois")
+
+    # ========================================
+    # END OF POLYGON ROI CONFIGURATION
+    # ========================================
+
+    if process_workers > 0:
+        for feature, enabled in (("Tracking", tracking), ("Motion gating", motion_gating),
+                                 ("Detection cache", detection_cache_dir),
+                                 ("Instrumentation", instrumentation or profile_frames > 0)):
+            if enabled:
+                print(f"{feature} is not available with process_workers > 0; disabled")
+        tracking = motion_gating = instrumentation = False
+        detection_cache_dir = None
+        profile_frames = 0
+
+    def is_inside_roi(xyxy, roi):
+        x1, y1, x2, y2 = int(xyxy[0]), int(xyxy[1]), int(xyxy[2]), int(xyxy[3])
+        roi_x1, roi_y1 = roi[0]
+        roi_x2, roi_y2 = roi[1]
+        return (x1 >= roi_x1 and y1 >= roi_y1 and x2 <= roi_x2 and y2 <= roi_y2)
+
+    def run_inference(frames, imgsz=full_imgsz):
+        # One model call for the whole micro-batch, split back into per-frame results
+        options = {}
+        if model_class_filter:
+            table = detection_filter.table  # swapped by ROI reloads on the post-process thread
+            options = {"classes": table.model_classes, "conf": table.model_conf}
+        elif cache_conf is not None:
+            options = {"conf": cache_conf}
+        return model(frames, imgsz, **options)
+
+    detector = run_inference
+    if tiled_inference:
+        if roi_crop_inference:
+            print("roi_crop_inference is ignored while tiled_inference is enabled")
+            roi_crop_inference = False
+        tile_rects = roi_tile_rects(roi_index, tile_far_size, tile_near_size, tile_overlap)
+        detector = tiled_detector = TiledDetector(lambda tiles: run_inference(tiles, tile_imgsz), tile_rects,
+                                                  run_inference if tile_full_frame else None, tile_nms_iou)
+        print(f"Tiled inference: {len(tile_rects)} tile(s) at imgsz {tile_imgsz}, "
+              f"{detector.pixel_fraction(process_width, process_height):.0%} of the frame"
+              + (" + full frame" if tile_full_frame else ""))
+    elif roi_crop_inference:
+        crop_rects = roi_crop_rects(roi_index, roi_crop_padding, roi_crop_merge_gap)
+        crop_imgsz = crop_inference_size(crop_rects, process_width, process_height, model_imgsz)
+        detector = cropped_detector = CroppedDetector(lambda crops: run_inference(crops, crop_imgsz), crop_rects)
+        print(f"ROI-cropped inference: {len(crop_rects)} crop(s) at imgsz {crop_imgsz}, "
+              f"{detector.pixel_fraction(process_width, process_height):.0%} of the frame")
+
+    # The stateless part of the detector (model + crops / tiles), used for the warm-up
+    inference_detector = detector
+
+    motion_gate = None
+    if motion_gating:
+        motion_gate = MotionGate(roi_index.label_map != 0, motion_downscale, motion_pixel_threshold,
+                                 motion_min_changed_fraction, motion_refresh_interval)
+        # The tracker must not take the last detections of a skipped frame as fresh ones
+        detector = MotionGatedDetector(detector, motion_gate, reuse_last=not tracking)
+
+    tracked_detector = None
+    if tracking:
+        tracked_detector = TrackedDetector(detector, IoUTracker(track_iou_threshold, track_max_age),
+                                           track_detect_interval, track_refresh_confidence)
+        detector = tracked_detector
+
+    model_weights = onnx_model_path if inference_backend == "onnxruntime" else model_path
+
+    # --- DETECTION CACHE ---
+    # Parameters that change the raw detections are part of the cache key
+    cache_params = {
+        "imgsz": full_imgsz,
+        # A fixed-shape ONNX model's own input shape is covered by the weights in the key
+        "backend": [inference_backend, list(onnx_input_shape)
+                    if inference_backend == "onnxruntime" and onnx_input_shape else None],
+        "frame_stride": frame_stride,
+        "frame_size": [process_width, process_height],
+        "roi_crop": [list(r) for r in crop_rects] if roi_crop_inference else None,
+        "tiles": [[list(t) for t in tile_rects], tile_imgsz, tile_full_frame,
+                  tile_nms_iou] if tiled_inference else None,
+        "motion": [motion_downscale, motion_pixel_threshold, motion_min_changed_fraction,
+                   motion_refresh_interval] if motion_gating else None,
+    }
+    detection_cache = None
+    cache_conf = None
+    if detection_cache_dir and tracking:
+        # Cached boxes would lose their track IDs, and the tracker needs every frame
+        print("Detection cache disabled while tracking is enabled")
+    elif detection_cache_dir:
+        # Raw detections are cached for every class down to cache_conf, so changing
+        # allowed_class_ids or thresholds above it re-filters the cached boxes instead of
+        # re-running the model
+        cache_conf = min(detection_filter.table.model_conf, detection_cache_min_conf)
+        if cache_conf < detection_cache_min_conf:
+            print(f"Warning: ROI rules / conf_threshold go down to {cache_conf:g}, below "
+                  f"detection_cache_min_conf ({detection_cache_min_conf:g}); detections are cached "
+                  f"down to {cache_conf:g} for this run")
+        cache_params["cache_conf"] = cache_conf
+        detection_cache = DetectionCache(detection_cache_dir,
+                                         cache_key(video_path, model_weights, cache_params, detection_cache_dir))
+        model_class_filter = False
+
+    # --- LOAD MODEL ---
+    if process_workers > 0:
+        # Every worker process loads its own model
+        model = None
+        class_names = None
+    elif detection_cache is not None and detection_cache.is_warm:
+        # Warm cache: only filtering and output run, the model is never loaded
+        model = None
+        class_names = detection_cache.class_names
+        print(f"Using cached detections for {detection_cache.frame_count} frames: {detection_cache.path}")
+    else:
         try:
-            results = model(frame)[0]
+            model = load_backend(inference_backend, model_weights, inference_threads, onnx_input_shape,
+                                 model_cache_dir, model_path)
+            class_names = model.names
+            print(f"YOLOv8 model loaded successfully! (backend: {model.name})")
         except Exception as e:
-            print(f"Error during inference on frame {frame_count}: {e}")
-            continue
-
-        for det in results.boxes:
-            try:
-                cls_id = int(det.cls.item())
-                if cls_id not in allowed_class_ids:
-                    continue
-
-                xyxy = det.xyxy[0].tolist()
-                conf = float(det.conf.item())
-
-                # Get center point of detected object
-                center_x = int((xyxy[0] + xyxy[2]) / 2)
-                center_y = int((xyxy[1] + xyxy[3]) / 2)
-
-                # Filter only if the center point is inside either polygon ROI
-                if not (is_inside_polygon(center_x, center_y, road1_polygon) or 
-                        is_inside_polygon(center_x, center_y, road2_polygon)):
-                    continue
-
-                x1, y1, x2, y2 = map(int, xyxy)
-                label = model.names[cls_id]
-
-                # Draw bounding box
-                cv2.rectangle(frame, (x1, y1), (x2, y2), (0, 255, 0), 2)
-                cv2.putText(frame, f"{label} {conf:.2f}", (x1, y1 - 10),
-                            cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 255, 0), 2)
-            except Exception as e:
-                print(f"Error processing detection on frame {frame_count}: {e}")
-                continue
-
-        # Draw polygon ROIs
-        cv2.polylines(frame, [road1_polygon], True, (255, 0, 0), 1)
-        cv2.polylines(frame, [road2_polygon], True, (0, 0, 255), 1)
-        cv2.polylines(frame, [road2_polygon], True, (0, 255, 0), 1)
-        
-        # Add ROI labels
-        cv2.putText(frame, "road1", (road1_points[0][0], road1_points[0][1] - 10),
-                    cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 0, 0), 2)
-        cv2.putText(frame, "road2", (road2_points[0][0], road2_points[0][1] - 10),
-                    cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 0, 255), 2)
+            print(f"Error loading YOLOv8 model: {e}")
+            cap.release()
+            roi_watcher.stop()
+            sys.exit(1)
+
+        if detection_cache is not None and not os.path.isfile(model_weights):
+            # Re-key with the weights file that was just downloaded / resolved
+            detection_cache = DetectionCache(detection_cache_dir, cache_key(video_path, model.weights_path,
+                                                                            cache_params, detection_cache_dir))
+        startup_timer.mark("model")
+
+        # --- WARM-UP ---
+        # The same model calls as a real batch (shapes, imgsz, crops / tiles), on dummy frames
+        if model_warmup_runs > 0:
+            warmup_frames = [np.full((process_height, process_width, 3), 114, np.uint8)] * inference_batch_size
+            started = time.perf_counter()
+            for _ in range(model_warmup_runs):
+                inference_detector(warmup_frames)
+            print(f"Model warmed up in {time.perf_counter() - started:.2f}s "
+                  f"({model_warmup_runs} run(s) at {process_width}x{process_height})")
+            startup_timer.mark("warm-up")
+
+    # Skip all drawing when nobody will look at the frames
+    render_frames = not headless or video_output_path is not None
+
+    stage_timer = None
+    if instrumentation or profile_frames > 0:
+        stage_timer = StageTimer(report_interval=instrumentation_report_interval,
+                                 jsonl_path=instrumentation_jsonl_path,
+                                 prometheus_path=instrumentation_prometheus_path,
+                                 profile_start=profile_start_frame, profile_frames=profile_frames)
+
+    def swap_rois(new_index):
+        """Switch every ROI-dependent structure to a reloaded ROI set (called between frames)."""
+        global roi_index
+        model_filter = (detection_filter.table.model_classes, detection_filter.table.model_conf)
+        roi_index = new_index
+        detection_filter.set_roi_index(new_index)
+        roi_overlay.set_rois(new_index.polygons, new_index.names)
+        print("Reloaded polygon ROI: " + ", ".join(f"{name} ({len(pts)} points)"
+                                                   for name, pts in zip(new_index.names, new_index.polygons)))
+
+        model_filter_changed = model_class_filter and model_filter != (detection_filter.table.model_classes,
+                                                                       detection_filter.table.model_conf)
+        if cache_conf is not None and detection_filter.table.model_conf < cache_conf:
+            print(f"Warning: the reloaded ROI rules go down to {detection_filter.table.model_conf:g}, below the "
+                  f"{cache_conf:g} the detections of this run are made at; restart to apply them")
+        if not (roi_crop_inference or tiled_inference or motion_gating or model_filter_changed):
+            return
+        if model is None:
+            print("Cached detections keep the previous crop / tile / motion regions and model classes "
+                  "until the cache is rebuilt")
+            return
+        # The detector is only touched by the inference thread, between two batches
+        pipeline.call_in_inference(lambda: swap_inference_rois(new_index))
+
+    def swap_inference_rois(new_index):
+        """Inference-side half of swap_rois(); runs on the inference thread between batches."""
+        global crop_imgsz, detection_cache
+        if roi_crop_inference:
+            crop_rects = roi_crop_rects(new_index, roi_crop_padding, roi_crop_merge_gap)
+            crop_imgsz = crop_inference_size(crop_rects, process_width, process_height, model_imgsz)
+            cropped_detector.rects = crop_rects
+        if tiled_inference:
+            tiled_detector.tiles = roi_tile_rects(new_index, tile_far_size, tile_near_size, tile_overlap)
+        if motion_gate is not None:
+            motion_gate.set_mask(new_index.label_map != 0)
+        if detection_cache is not None:
+            # Raw detections now depend on the new regions, so this run can no longer be cached
+            pipeline.cache = None
+            detection_cache = None
+            print("Detection cache disabled for this run (ROI-dependent inference changed)")
+
+    def annotate_frame(packet):
+        frame = packet.frame
+        new_index = roi_watcher.poll()
+        if new_index is not None:
+            swap_rois(new_index)
+        packet.roi_index = roi_index
+        if stage_timer is not None:
+            started = time.perf_counter()
+        packet.detections = detection_filter(packet.raw)
+        if stage_timer is not None:
+            stage_timer.record("filter", time.perf_counter() - started)
+        if not render_frames:
+            return
+        if stage_timer is not None:
+            started = time.perf_counter()
+        draw_detections(frame, packet.detections, class_names)
+
+        # Draw polygon ROIs and their labels from the pre-rendered layer
+        roi_overlay.apply(frame)
 
         # Add frame counter
-        cv2.putText(frame, f"Frame: {frame_count}/{total_frames}", (10, 30),
+        cv2.putText(frame, f"Frame: {packet.index}/{total_frames}", (10, 30),
                     cv2.FONT_HERSHEY_SIMPLEX, 0.7, (255, 255, 255), 2)
+        if stage_timer is not None:
+            stage_timer.record("draw", time.perf_counter() - started)
 
-        cv2.imshow("YOLOv8 Detection with ROI + Class Filter", frame)
-
-        if cv2.waitKey(1) & 0xFF == ord('q'):
-            print("Quit requested by user")
-            break
-
-except KeyboardInterrupt:
-    print("\nInterrupted by user (Ctrl+C)")
-except Exception as e:
-    print(f"Unexpected error during video processing: {e}")
-finally:
-    cap.release()
-    cv2.destroyAllWindows()
-    print("Resources cleaned up successfully")
+    if process_workers > 0:
+        from process_pipeline import DetectionStage, ProcessFramePipeline
+        try:
+            if inference_backend == "onnxruntime" and not os.path.isfile(model_weights):
+                # Once here, rather than in every worker at the same time
+                print(f"Exporting '{model_path}' to '{model_weights}' (first start only)")
+                export_onnx(model_path, model_weights)
+            if inference_backend == "onnxruntime" and model_cache_dir:
+                file_sha1(model_weights, model_cache_dir)  # hash index written before workers read it
+        except Exception as e:
+            print(f"Error loading YOLOv8 model: {e}")
+            cap.release()
+            roi_watcher.stop()
+            sys.exit(1)
+        stage = DetectionStage(model_weights, full_imgsz, roi_config_path, roi_compiled_cache_dir,
+                               (process_width, process_height), allowed_class_ids, conf_threshold,
+                               render_frames, roi_fill_alpha,
+                               (roi_crop_padding, roi_crop_merge_gap) if roi_crop_inference else None,
+                               total_frames, max(1, (os.cpu_count() or 1) // process_workers),
+                               roi_rules, model_class_filter,
+                               (tile_far_size, tile_near_size, tile_overlap, tile_imgsz, tile_full_frame,
+                                tile_nms_iou) if tiled_inference else None,
+                               inference_backend, onnx_input_shape, model_cache_dir,
+                               model_warmup_runs, inference_batch_size)
+        pipeline = ProcessFramePipeline(cap, stage, process_workers, process_ring_slots, frame_stride,
+                                        (process_width, process_height), inference_batch_size)
+        try:
+            pipeline.start()
+        except RuntimeError as e:
+            print(f"Error starting worker processes: {e}")
+            cap.release()
+            roi_watcher.stop()
+            sys.exit(1)
+        class_names = pipeline.stage_info
+        print(f"YOLOv8 model loaded in {process_workers} worker processes "
+              f"({pipeline.ring_slots} shared frame slots)")
+        startup_timer.mark("workers")
+    else:
+        # Decode, inference and post-processing run on their own threads;
+        # the display stays on the main thread
+        pipeline = FramePipeline(cap, detector, annotate_frame,
+                                 decode_queue_size, inference_queue_size, postprocess_queue_size,
+                                 inference_batch_size, inference_batch_wait_ms, detection_cache,
+                                 stage_timer, frame_stride, (process_width, process_height),
+                                 reuse_frame_buffers)
+
+    # --- OUTPUTS ---
+    jsonl_writer = None
+    video_writer = None
+    event_store = None
+    try:
+        if event_store_path:
+            from event_store import EventStore
+            event_store = EventStore(event_store_path, roi_index.names, class_names, event_store_start_time)
+        if jsonl_output_path:
+            jsonl_writer = JsonlDetectionWriter(jsonl_output_path, class_names, roi_index)
+        if video_output_path:
+            video_writer = VideoWriterThread(video_output_path, fps / frame_stride, (process_width, process_height))
+    except Exception as e:
+        print(f"Error opening outputs: {e}")
+        cap.release()
+        sys.exit(1)
+
+    if headless:
+        print("Starting headless video processing... Press Ctrl+C to stop")
+    else:
+        print("Starting video processing... Press 'q' to quit")
+
+    allocation_monitor = AllocationMonitor(allocation_report_interval) if allocation_debug else None
+
+    frames_processed = 0
+    try:
+        for packet in pipeline:
+            frames_processed += 1
+            if frames_processed == 1:
+                startup_timer.first_frame()
+            if stage_timer is not None:
+                stage_timer.profile_enter(packet.index)
+                started = time.perf_counter()
+            if jsonl_writer is not None:
+                jsonl_writer.write(packet)
+            if event_store is not None:
+                event_store.append(packet, packet.roi_index if packet.roi_index is not None else roi_index)
+            if video_writer is not None:
+                # Copied into the writer's own buffers: this frame is recycled with the next packet
+                video_writer.write(packet.frame)
+            if stage_timer is not None:
+                stage_timer.record("output", time.perf_counter() - started)
+
+            key = -1
+            if headless:
+                if frames_processed % 100 == 0:
+                    print(f"Processed frame {packet.index}/{total_frames}")
+            else:
+                if stage_timer is not None:
+                    started = time.perf_counter()
+                cv2.imshow("YOLOv8 Detection with ROI + Class Filter", packet.frame)
+                key = cv2.waitKey(1) & 0xFF
+                if stage_timer is not None:
+                    stage_timer.record("display", time.perf_counter() - started)
+
+            if stage_timer is not None:
+                stage_timer.profile_exit()
+                stage_timer.frame_done(packet.index)
+            if allocation_monitor is not None:
+                allocation_monitor.frame_done()
+
+            if key == ord('q'):
+                print("Quit requested by user")
+                break
+
+    except KeyboardInterrupt:
+        print("\nInterrupted by user (Ctrl+C)")
+    except Exception as e:
+        print(f"Unexpected error during video processing: {e}")
+    finally:
+        pipeline.stop()
+        roi_watcher.stop()
+        if stage_timer is not None:
+            stage_timer.report()
+            if not stage_timer.profile_dumped:
+                stage_timer.dump_profile()
+        if allocation_monitor is not None:
+            allocation_monitor.stop()
+        if motion_gate is not None:
+            print(motion_gate.summary())
+        if tracked_detector is not None:
+            print(tracked_detector.summary())
+        if detection_cache is not None and not detection_cache.is_warm and pipeline.reached_end:
+            if detection_cache.save(class_names, pipeline.frames_decoded, frame_stride):
+                print(f"Saved detection cache: {detection_cache.path}")
+        if jsonl_writer is not None:
+            jsonl_writer.close()
+        if event_store is not None:
+            event_store.close()
+        if video_writer is not None:
+            video_writer.close()
+        cap.release()
+        if not headless:
+            cv2.destroyAllWindows()
+        print("Resources cleaned up successfully")
@@ -0,0 +1,105 @@
+# Title: Motion gating - skip inference on frames with no change inside the ROIs
+
+import cv2
+import numpy as np
+
+
+class MotionGate:
+    """Cheap change detector restricted to the ROI mask.
+
+    Frames are converted to downscaled grayscale and compared against the
+    frame the model last ran on. Inference is requested when the fraction
+    of changed ROI pixels exceeds min_changed_fraction, or when
+    refresh_interval frames have passed since the last inference.
+
+    All intermediate images live in scratch buffers that are reused from
+    frame to frame; the blurred result alternates between two of them so
+    the reference survives the next comparison.
+    """
+
+    def __init__(self, roi_mask, downscale=4, pixel_threshold=25,
+                 min_changed_fraction=0.002, refresh_interval=30):
+        self.downscale = max(1, int(downscale))
+        self.pixel_threshold = pixel_threshold
+        self.min_changed_fraction = min_changed_fraction
+        self.refresh_interval = max(1, int(refresh_interval))
+
+        height, width = roi_mask.shape[:2]
+        self.size = (max(1, width // self.downscale), max(1, height // self.downscale))
+        self.set_mask(roi_mask)
+
+        self.reference = None
+        self.gray = None
+        self.small = None
+        self.blurred = [None, None]
+        self.diff = None
+        self.frames_since_inference = 0
+        self.inferred = 0
+        self.skipped = 0
+
+    def set_mask(self, roi_mask):
+        """Replace the ROI mask (same frame size); the next frame is always inferred."""
+        small_mask = cv2.resize(roi_mask.astype(np.uint8), self.size, interpolation=cv2.INTER_NEAREST)
+        self.mask_pixels = max(1, int((small_mask != 0).sum()))
+        self.mask = small_mask != 0
+        self.mask_u8 = self.mask.astype(np.uint8) * 255
+        self.reference = None
+
+    def _prepare(self, frame):
+        self.gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=self.gray)
+        self.small = cv2.resize(self.gray, self.size, dst=self.small, interpolation=cv2.INTER_AREA)
+        slot = 1 if self.reference is self.blurred[0] else 0
+        self.blurred[slot] = cv2.GaussianBlur(self.small, (3, 3), 0, dst=self.blurred[slot])
+        return self.blurred[slot]
+
+    def should_infer(self, frame):
+        small = self._prepare(frame)
+        self.frames_since_inference += 1
+
+        run = self.reference is None or self.frames_since_inference >= self.refresh_interval
+        if not run:
+            self.diff = cv2.absdiff(small, self.reference, dst=self.diff)
+            cv2.threshold(self.diff, self.pixel_threshold, 255, cv2.THRESH_BINARY, dst=self.diff)
+            changed = cv2.countNonZero(cv2.bitwise_and(self.diff, self.mask_u8, dst=self.diff))
+            run = changed / self.mask_pixels > self.min_changed_fraction
+
+        if run:
+            self.reference = small
+            self.frames_since_inference = 0
+            self.inferred += 1
+        else:
+            self.skipped += 1
+        return run
+
+    def summary(self):
+        total = self.inferred + self.skipped
+        pct = 100.0 * self.skipped / total if total else 0.0
+        return f"Motion gate: skipped {self.skipped} of {total} inferences ({pct:.1f}%)"
+
+
+class MotionGatedDetector:
+    """Wraps a batch detector; frames the gate rejects reuse the last detections.
+
+    With reuse_last=False they get None instead, so a caller that keeps its
+    own state (the tracker) can tell a skipped frame from a fresh detection.
+    """
+
+    def __init__(self, detector, gate, reuse_last=True):
+        self.detector = detector
+        self.gate = gate
+        self.reuse_last = reuse_last
+        self.last = None
+
+    def __call__(self, frames):
+        decisions = [self.gate.should_infer(frame) for frame in frames]
+        to_run = [frame for frame, run in zip(frames, decisions) if run]
+        fresh = iter(self.detector(to_run) if to_run else [])
+
+        results = []
+        for run in decisions:
+            if run:
+                self.last = next(fresh)
+                results.append(self.last)
+            else:
+                results.append(self.last if self.reuse_last else None)
+        return results
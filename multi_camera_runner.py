@@ -0,0 +1,240 @@
+# Title: Multi-camera runner - many (video, ROI session) streams across a process pool
+#
+# Usage:
+#   python multi_camera_runner.py cameras.json --output detections.jsonl
+#
+# cameras.json:
+#   {
+#     "model": "yolov8n.pt",
+#     "backend": "ultralytics",
+#     "onnx_model": "yolov8n.onnx",
+#     "allowed_class_ids": [1, 2, 3, 5, 7, 9],
+#     "conf_threshold": 0.25,
+#     "streams": [
+#       {"name": "intersection", "video": "intersectionRoad1.mp4",
+#        "roi_session": "roi_mapping_results/intersectionRoad1_20250718_165220"},
+#       {"name": "straight", "video": "straightroad.mp4",
+#        "roi_session": "roi_mapping_results/straightroad_20250718_174225"}
+#     ]
+#   }
+# "backend": "onnxruntime" runs "onnx_model" on ONNX Runtime instead of PyTorch (exported from
+# "model" first if missing).
+
+import argparse
+import json
+import multiprocessing as mp
+import os
+import sys
+import threading
+import time
+
+import cv2
+
+from detection_filter import DetectionFilter
+from inference_backend import export_onnx, load_backend
+from outputs import detection_records
+from pipeline import FramePipeline
+from roi_index import ROIIndex, load_roi_session
+from roi_rules import load_roi_rules, rules_path_for
+
+# Seconds between per-stream throughput reports
+REPORT_INTERVAL = 10.0
+
+# --- WORKER PROCESS STATE (set once per worker by _init_worker) ---
+_model = None
+_model_error = None
+_results = None
+# Streams sharing a worker run in threads; the model is called by one at a time
+_model_lock = threading.Lock()
+
+
+def _init_worker(backend, model_path, results, threads_per_worker):
+    """Load the model once per worker process."""
+    global _model, _model_error, _results
+    _results = results
+    cv2.setNumThreads(threads_per_worker)
+    try:
+        _model = load_backend(backend, model_path, threads_per_worker)
+    except Exception as e:
+        # Reported per stream; raising here would make the pool respawn workers forever
+        _model_error = f"Error loading YOLOv8 model: {e}"
+
+
+def _open_source(source):
+    # Digits select a local camera, anything else is a file path or stream URL
+    return cv2.VideoCapture(int(source) if str(source).isdigit() else source)
+
+
+def _run_stream(task):
+    """Process one stream to the end; never raises so other streams keep going."""
+    stream, settings = task
+    name = stream["name"]
+    started = time.monotonic()
+    frames = 0
+    try:
+        if _model is None:
+            raise RuntimeError(_model_error)
+        cap = _open_source(stream["video"])
+        if not cap.isOpened():
+            raise IOError(f"Could not open video source '{stream['video']}'")
+        width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+
+        # ROIs drawn on another resolution are rescaled to the stream
+        roi_names, polygons, _ = load_roi_session(stream["roi_session"], (width, height))
+        roi_index = ROIIndex(polygons, roi_names, width, height)
+        # The session's roi_rules.json, as in main.py
+        rules = load_roi_rules(rules_path_for(stream["roi_session"]))
+        detection_filter = DetectionFilter(roi_index, settings["allowed_class_ids"],
+                                           settings["conf_threshold"], rules)
+
+        table = detection_filter.table
+
+        def run_inference(frames_batch):
+            # Same model call as main.py: only classes and confidences some ROI keeps
+            with _model_lock:
+                return _model(frames_batch, classes=table.model_classes, conf=table.model_conf)
+
+        def filter_frame(packet):
+            packet.detections = detection_filter(packet.raw)
+
+        pipeline = FramePipeline(cap, run_inference, filter_frame,
+                                 batch_size=settings["batch_size"],
+                                 batch_wait_ms=settings["batch_wait_ms"])
+        last_report = started
+        try:
+            for packet in pipeline:
+                frames += 1
+                _results.put(("detections", name, {
+                    "stream": name, "frame": packet.index,
+                    "timestamp_ms": round(packet.timestamp_ms, 3),
+                    "detections": detection_records(packet, _model.names, roi_index)}))
+
+                now = time.monotonic()
+                if now - last_report >= REPORT_INTERVAL:
+                    _results.put(("progress", name, {"frames": frames, "fps": frames / (now - started)}))
+                    last_report = now
+        finally:
+            pipeline.stop()
+            cap.release()
+    except Exception as e:
+        elapsed = time.monotonic() - started
+        return {"stream": name, "status": "failed", "error": str(e),
+                "frames": frames, "seconds": round(elapsed, 2)}
+
+    elapsed = time.monotonic() - started
+    return {"stream": name, "status": "done", "frames": frames, "seconds": round(elapsed, 2),
+            "fps": round(frames / elapsed, 2) if elapsed > 0 else 0.0}
+
+
+def _run_streams(task):
+    """Process the streams assigned to one worker concurrently, one thread each.
+
+    Decoding, filtering and output of every stream overlap; only model calls
+    take turns. Each summary is also sent to the sink when its stream ends.
+    """
+    streams, settings = task
+    summaries = [None] * len(streams)
+
+    def run_one(i):
+        summaries[i] = _run_stream((streams[i], settings))
+        _results.put(("finished", streams[i]["name"], summaries[i]))
+
+    threads = [threading.Thread(target=run_one, args=(i,), daemon=True) for i in range(len(streams))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summaries
+
+
+def _sink_loop(results, output_path):
+    """Single writer for all streams: JSON lines to the output, progress to the console."""
+    with open(output_path, "w", buffering=1 << 16) as out:
+        while True:
+            message = results.get()
+            if message is None:
+                break
+            kind, name, payload = message
+            if kind == "detections":
+                out.write(json.dumps(payload) + "\n")
+            elif kind == "progress":
+                print(f"[{name}] {payload['frames']} frames, {payload['fps']:.1f} FPS")
+            elif kind == "finished":
+                if payload["status"] == "done":
+                    print(f"[{name}] done: {payload['frames']} frames "
+                          f"in {payload['seconds']}s ({payload['fps']} FPS)")
+                else:
+                    print(f"[{name}] failed after {payload['frames']} frames: {payload['error']}")
+
+
+def run(manifest_path, output_path, workers=None):
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+
+    streams = manifest["streams"]
+    if not streams:
+        print("Manifest has no streams")
+        return []
+    settings = {
+        "allowed_class_ids": manifest.get("allowed_class_ids", [1, 2, 3, 5, 7, 9]),
+        "conf_threshold": manifest.get("conf_threshold", 0.25),
+        "batch_size": manifest.get("batch_size", 1),
+        "batch_wait_ms": manifest.get("batch_wait_ms", 0),
+    }
+    backend = manifest.get("backend", "ultralytics")
+    model_path = manifest.get("model", "yolov8n.pt")
+    weights = manifest.get("onnx_model", "yolov8n.onnx") if backend == "onnxruntime" else model_path
+    if backend == "onnxruntime" and not os.path.isfile(weights):
+        # Once here, rather than in every worker at the same time
+        print(f"Exporting '{model_path}' to '{weights}' (first start only)")
+        try:
+            export_onnx(model_path, weights)
+        except Exception as e:
+            raise IOError(f"Could not export '{model_path}' to ONNX: {e}")
+
+    cores = os.cpu_count() or 1
+    workers = max(1, min(workers or cores, len(streams)))
+    threads_per_worker = max(1, cores // workers)
+
+    # Bounded so a slow sink applies back-pressure instead of growing without limit
+    results = mp.Queue(maxsize=1024)
+    sink = threading.Thread(target=_sink_loop, args=(results, output_path), daemon=True)
+    sink.start()
+
+    # Every stream starts right away: with more streams than workers, a worker runs several
+    # (live sources would otherwise wait for another stream to end, i.e. forever)
+    groups = [(streams[i::workers], settings) for i in range(workers)]
+    print(f"Processing {len(streams)} stream(s) with {workers} worker(s)")
+    summaries = []
+    with mp.Pool(workers, initializer=_init_worker,
+                 initargs=(backend, weights, results, threads_per_worker)) as pool:
+        for group_summaries in pool.imap_unordered(_run_streams, groups):
+            summaries.extend(group_summaries)
+
+    results.put(None)
+    sink.join()
+    return summaries
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run ROI-filtered detection on many cameras in parallel")
+    parser.add_argument("manifest", help="JSON manifest of {name, video, roi_session} streams")
+    parser.add_argument("--output", default="multi_camera_detections.jsonl",
+                        help="JSON-lines file receiving the detections of all streams")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Worker processes (default: one per core, at most one per stream)")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.manifest):
+        print(f"Error: Manifest '{args.manifest}' not found!")
+        sys.exit(1)
+
+    try:
+        summaries = run(args.manifest, args.output, args.workers)
+    except IOError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    failed = [s for s in summaries if s["status"] != "done"]
+    print(f"Finished: {len(summaries) - len(failed)} stream(s) done, {len(failed)} failed")
+    sys.exit(1 if failed else 0)
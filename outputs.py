@@ -0,0 +1,114 @@
+# Title: Output sinks - JSON-lines detections and background annotated-video writer
+
+import json
+import queue
+import threading
+
+import cv2
+import numpy as np
+
+
+def detection_records(packet, class_names, roi_index):
+    """Return one dict per filtered detection of a frame packet.
+
+    Boxes are in source-video pixels, also when frames were downscaled for processing.
+    """
+    dets = packet.detections
+    if dets is None or len(dets) == 0:
+        return []
+    if packet.scale is not None:
+        dets = dets.scaled(*packet.scale)
+    membership = roi_index.membership(dets.roi_bits)
+    names = np.array(roi_index.names, dtype=object)
+    # Round in float64 so the JSON does not carry float32 noise digits
+    boxes = np.round(dets.xyxy.astype(np.float64), 1).tolist()
+    confs = np.round(dets.conf.astype(np.float64), 4).tolist()
+    records = [{"rois": names[rois].tolist(), "class_id": cls_id, "class": class_names[cls_id],
+                "conf": conf, "box": box}
+               for rois, cls_id, conf, box in zip(membership, dets.cls.tolist(), confs, boxes)]
+    if dets.track_ids is not None:
+        for record, track_id in zip(records, dets.track_ids.tolist()):
+            record["track_id"] = track_id
+    return records
+
+
+def roi_occupancy(packet, roi_index):
+    """Number of filtered detections (or tracks) per ROI name in a frame."""
+    dets = packet.detections
+    if dets is None or len(dets) == 0:
+        return {name: 0 for name in roi_index.names}
+    counts = roi_index.membership(dets.roi_bits).sum(axis=0).tolist()
+    return dict(zip(roi_index.names, counts))
+
+
+class JsonlDetectionWriter:
+    """Writes one JSON line per processed frame:
+
+        {"frame": 12, "timestamp_ms": 400.0, "occupancy": {"road1": 1, "road2": 0},
+         "detections": [{"rois": ["road1"], "class_id": 2, "class": "car",
+                         "conf": 0.87, "box": [x1, y1, x2, y2], "track_id": 7}]}
+
+    track_id is only present when the tracker is enabled. ROI names come from
+    packet.roi_index when the frame carries one (ROI sets can be hot-reloaded),
+    else from the roi_index given here.
+    """
+
+    def __init__(self, path, class_names, roi_index):
+        self.file = open(path, "w", buffering=1 << 16)
+        self.class_names = class_names
+        self.roi_index = roi_index
+
+    def write(self, packet):
+        roi_index = packet.roi_index if packet.roi_index is not None else self.roi_index
+        record = {"frame": packet.index,
+                  "timestamp_ms": round(packet.timestamp_ms, 3),
+                  "occupancy": roi_occupancy(packet, roi_index),
+                  "detections": detection_records(packet, self.class_names, roi_index)}
+        self.file.write(json.dumps(record) + "\n")
+
+    def close(self):
+        self.file.close()
+
+
+class VideoWriterThread:
+    """cv2.VideoWriter running on a background thread behind a bounded queue,
+    so encoding the annotated MP4 overlaps with detection.
+
+    write() copies the frame into one of queue_size + 1 recycled buffers, so
+    the caller may reuse its frame (pooled or shared-memory) right away and
+    steady-state encoding allocates nothing.
+    """
+
+    def __init__(self, path, fps, frame_size, queue_size=8, fourcc="mp4v"):
+        self.writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*fourcc), fps or 30.0, frame_size)
+        if not self.writer.isOpened():
+            raise IOError(f"Could not open video writer for '{path}'")
+        self.frames = queue.Queue(maxsize=queue_size)
+        self.free_buffers = queue.Queue()
+        self.buffers_left = queue_size + 1
+        self.thread = threading.Thread(target=self._write_loop, name="video-writer", daemon=True)
+        self.thread.start()
+
+    def _write_loop(self):
+        while True:
+            frame = self.frames.get()
+            if frame is None:
+                break
+            self.writer.write(frame)
+            self.free_buffers.put(frame)
+
+    def write(self, frame):
+        if self.buffers_left > 0 and self.free_buffers.empty():
+            self.buffers_left -= 1
+            buffer = np.empty_like(frame)
+        else:
+            buffer = self.free_buffers.get()
+            if buffer.shape != frame.shape:
+                buffer = np.empty_like(frame)
+        np.copyto(buffer, frame)
+        self.frames.put(buffer)
+
+    def close(self):
+        self.frames.put(None)
+        self.thread.join()
+        self.writer.release()
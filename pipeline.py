@@ -0,0 +1,357 @@
+# Title: Threaded decode / inference / post-process pipeline with bounded queues
+
+import math
+import queue
+import threading
+import time
+
+import cv2
+
+# Marks the end of the stream as it travels through the queues
+_END = object()
+
+
+def stride_for_fps(source_fps, target_fps):
+    """Frame stride that brings source_fps down to (at most) target_fps."""
+    if not target_fps or not source_fps or source_fps <= target_fps:
+        return 1
+    return max(1, int(round(source_fps / target_fps)))
+
+
+def processing_size(frame_width, frame_height, target_width=None):
+    """Frame size after downscaling to target_width (aspect kept, even height); never upscales."""
+    if not target_width or target_width >= frame_width:
+        return frame_width, frame_height
+    height = int(round(frame_height * target_width / frame_width / 2.0)) * 2
+    return int(target_width), max(2, height)
+
+
+def full_frame_imgsz(frame_width, frame_height, model_imgsz=640, stride=32):
+    """Full-frame inference size: model_imgsz, but never above the frame's long side (rounded
+    up to the model stride), so downscaled frames are not upscaled again by the letterbox."""
+    return min(model_imgsz, int(math.ceil(max(frame_width, frame_height) / stride)) * stride)
+
+
+class FramePacket:
+    """A frame and everything computed for it as it moves through the stages."""
+
+    __slots__ = ("index", "timestamp_ms", "frame", "raw", "detections", "roi_index", "scale")
+
+    def __init__(self, index, timestamp_ms, frame):
+        self.index = index
+        self.timestamp_ms = timestamp_ms
+        self.frame = frame
+        self.raw = None
+        self.detections = None
+        self.roi_index = None  # ROI set the detections were filtered with
+        self.scale = None      # (sx, sy) from frame to source-video pixels when downscaled
+
+
+class FramePipeline:
+    """Runs decode, inference and post-processing on their own threads.
+
+    Stages are connected by bounded FIFO queues, so decoding of frame N+1
+    overlaps with inference on frame N and throughput is limited by the
+    slowest stage. Each stage is a single thread, which keeps frames in
+    order. The sink is the caller's loop over the pipeline (it stays on
+    the main thread so cv2.imshow keeps working):
+
+        for packet in FramePipeline(cap, infer_fn, postprocess_fn):
+            ...
+
+    infer_fn(frames) takes a list of frames and returns one raw Detections
+    per frame; postprocess_fn(packet) fills in packet.detections and may
+    annotate packet.frame. Frames whose inference fails are reported and
+    dropped, like the sequential loop did.
+
+    The inference stage micro-batches: it collects up to batch_size frames,
+    waiting at most batch_wait_ms after the first one, and runs a single
+    model call on them. Large batches favor throughput (offline
+    re-processing), batch_size=1 favors latency (live feeds).
+
+    An optional detection cache (see DetectionCache) is consulted per frame
+    index before the model runs, and fresh results are stored back in it.
+    reached_end tells whether the whole stream was decoded, frames_decoded
+    how many frames were read.
+
+    With frame_stride N only every Nth frame (1, 1+N, 1+2N, ...) is
+    analyzed: the frames in between are skipped with cap.grab(), and only
+    analyzed frames pay for cap.retrieve() (conversion and copy). Packet
+    indices and timestamps are those of the original stream.
+
+    With frame_size (width, height) set, analyzed frames are downscaled to
+    that size in the decode thread (cv2.INTER_AREA), so every later stage
+    and queue handles the smaller frame; packet.scale maps coordinates back
+    to the source resolution.
+
+    With reuse_buffers=True frames are decoded into a fixed pool of arrays
+    (cap.retrieve / cv2.resize write into a free one) instead of a new
+    array per frame. A packet's frame goes back to the pool when the caller
+    asks for the next packet, so the caller must copy anything it keeps
+    longer. The pool covers every frame that can be in flight (all queues,
+    one batch, one frame per stage thread and the caller's); decoding
+    waits for a free buffer rather than allocating past it.
+
+    An optional StageTimer receives per-frame "decode", "inference" and
+    "postprocess" durations and drives the cProfile window of each stage.
+
+    call_in_inference(fn) runs fn on the inference thread before its next
+    batch. Use it for anything that changes infer_fn's state (crop rects,
+    motion mask, cache) from another thread, so a model call never sees
+    half of an update.
+    """
+
+    def __init__(self, cap, infer_fn, postprocess_fn,
+                 decode_queue_size=4, inference_queue_size=4, postprocess_queue_size=4,
+                 batch_size=1, batch_wait_ms=0, cache=None, timer=None, frame_stride=1, frame_size=None,
+                 reuse_buffers=False):
+        self.cap = cap
+        self.infer_fn = infer_fn
+        self.postprocess_fn = postprocess_fn
+        self.batch_size = max(1, int(batch_size))
+        self.batch_wait = max(0.0, batch_wait_ms / 1000.0)
+        self.cache = cache
+        self.timer = timer
+        self.frame_stride = max(1, int(frame_stride))
+        self.frame_size = tuple(frame_size) if frame_size else None
+        self.scale = None
+        self.reached_end = False
+        self.frames_decoded = 0
+
+        self.free_buffers = None
+        if reuse_buffers:
+            self.free_buffers = queue.Queue()
+            # Every queue full, one batch in inference, one frame each in decode, post-process and the caller
+            self.pool_size = (decode_queue_size + inference_queue_size + postprocess_queue_size
+                              + self.batch_size + 3)
+            self.buffers_allocated = 0
+            source_size = (int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+            self.downscale = self.frame_size is not None and self.frame_size != source_size
+            self.source_buffer = None  # full-size decode target when frames are downscaled
+
+        self.inference_tasks = queue.Queue()
+        self.decoded = queue.Queue(maxsize=decode_queue_size)
+        self.inferred = queue.Queue(maxsize=inference_queue_size)
+        self.processed = queue.Queue(maxsize=postprocess_queue_size)
+
+        self.stop_event = threading.Event()
+        self.threads = [
+            threading.Thread(target=self._decode_loop, name="decode", daemon=True),
+            threading.Thread(target=self._inference_loop, name="inference", daemon=True),
+            threading.Thread(target=self._postprocess_loop, name="postprocess", daemon=True),
+        ]
+        self.started = False
+
+    def _put(self, q, item):
+        # Block while the next stage is busy, but give up once stop() was called
+        while not self.stop_event.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, q):
+        while not self.stop_event.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _END
+
+    def _acquire_buffer(self):
+        """A free pooled frame buffer; None lets OpenCV allocate one, which then joins the pool."""
+        try:
+            return self.free_buffers.get_nowait()
+        except queue.Empty:
+            pass
+        if self.buffers_allocated < self.pool_size:
+            self.buffers_allocated += 1
+            return None
+        buffer = self._get(self.free_buffers)
+        return None if buffer is _END else buffer
+
+    def release(self, packet):
+        """Return a packet's frame buffer to the pool (no-op without reuse_buffers)."""
+        if self.free_buffers is not None and packet.frame is not None:
+            self.free_buffers.put(packet.frame)
+            packet.frame = None
+
+    def _read_next(self):
+        """Advance to the next analyzed frame; returns its frame or None at the end."""
+        while True:
+            if not self.cap.grab():
+                return None
+            self.frames_decoded += 1
+            if (self.frames_decoded - 1) % self.frame_stride == 0:
+                break
+
+        if self.free_buffers is None:
+            ret, frame = self.cap.retrieve()
+            if not ret:
+                return None
+            if self.frame_size is not None and frame.shape[1::-1] != self.frame_size:
+                height, width = frame.shape[:2]
+                self.scale = (width / self.frame_size[0], height / self.frame_size[1])
+                frame = cv2.resize(frame, self.frame_size, interpolation=cv2.INTER_AREA)
+            return frame
+
+        buffer = self._acquire_buffer()
+        if not self.downscale:
+            ret, frame = self.cap.retrieve(buffer)
+            return frame if ret else None
+        ret, self.source_buffer = self.cap.retrieve(self.source_buffer)
+        if not ret:
+            return None
+        height, width = self.source_buffer.shape[:2]
+        self.scale = (width / self.frame_size[0], height / self.frame_size[1])
+        return cv2.resize(self.source_buffer, self.frame_size, buffer, interpolation=cv2.INTER_AREA)
+
+    def _decode_loop(self):
+        try:
+            timer = self.timer
+            while not self.stop_event.is_set():
+                if timer is not None:
+                    timer.profile_enter(self.frames_decoded + 1)
+                    started = time.perf_counter()
+                    frame = self._read_next()
+                    timer.record("decode", time.perf_counter() - started)
+                    timer.profile_exit()
+                else:
+                    frame = self._read_next()
+                if frame is None:
+                    print("End of video or failed to read frame")
+                    self.reached_end = True
+                    break
+                packet = FramePacket(self.frames_decoded, self.cap.get(cv2.CAP_PROP_POS_MSEC), frame)
+                packet.scale = self.scale
+                if not self._put(self.decoded, packet):
+                    return
+        except Exception as e:
+            print(f"Error decoding frame {self.frames_decoded + 1}: {e}")
+        self._put(self.decoded, _END)
+
+    def _next_batch(self):
+        """Collect up to batch_size packets; returns (packets, reached_end)."""
+        packet = self._get(self.decoded)
+        if packet is _END:
+            return [], True
+
+        batch = [packet]
+        deadline = time.monotonic() + self.batch_wait
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    packet = self.decoded.get(timeout=remaining)
+                else:
+                    packet = self.decoded.get_nowait()
+            except queue.Empty:
+                break
+            if packet is _END:
+                return batch, True
+            batch.append(packet)
+        return batch, False
+
+    def call_in_inference(self, fn):
+        """Run fn() on the inference thread between two batches."""
+        self.inference_tasks.put(fn)
+
+    def _run_inference_tasks(self):
+        while True:
+            try:
+                task = self.inference_tasks.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                task()
+            except Exception as e:
+                print(f"Error updating the detector between batches: {e}")
+
+    def _inference_loop(self):
+        reached_end = False
+        while not reached_end:
+            batch, reached_end = self._next_batch()
+            if not batch:
+                break
+            self._run_inference_tasks()
+
+            pending = batch
+            cache = self.cache
+            if cache is not None:
+                for packet in batch:
+                    packet.raw = cache.lookup(packet.index)
+                pending = [packet for packet in batch if packet.raw is None]
+
+            if pending:
+                timer = self.timer
+                if timer is not None:
+                    timer.profile_enter(pending[0].index)
+                    started = time.perf_counter()
+                try:
+                    results = self.infer_fn([packet.frame for packet in pending])
+                    for packet, raw in zip(pending, results):
+                        packet.raw = raw
+                        if cache is not None:
+                            cache.store(packet.index, raw)
+                except Exception as e:
+                    indices = ", ".join(str(packet.index) for packet in pending)
+                    print(f"Error during inference on frame(s) {indices}: {e}")
+                if timer is not None:
+                    # Amortized per frame, so batched and unbatched runs compare directly
+                    per_frame = (time.perf_counter() - started) / len(pending)
+                    for _ in pending:
+                        timer.record("inference", per_frame)
+                    timer.profile_exit()
+
+            for packet in batch:
+                if packet.raw is None:
+                    self.release(packet)
+                elif not self._put(self.inferred, packet):
+                    return
+        self._put(self.inferred, _END)
+
+    def _postprocess_loop(self):
+        while True:
+            packet = self._get(self.inferred)
+            if packet is _END:
+                break
+            timer = self.timer
+            if timer is not None:
+                timer.profile_enter(packet.index)
+                started = time.perf_counter()
+            try:
+                self.postprocess_fn(packet)
+            except Exception as e:
+                print(f"Error processing detections on frame {packet.index}: {e}")
+            if timer is not None:
+                timer.record("postprocess", time.perf_counter() - started)
+                timer.profile_exit()
+            if not self._put(self.processed, packet):
+                return
+        self._put(self.processed, _END)
+
+    def start(self):
+        if not self.started:
+            self.started = True
+            for thread in self.threads:
+                thread.start()
+        return self
+
+    def __iter__(self):
+        self.start()
+        while True:
+            packet = self._get(self.processed)
+            if packet is _END:
+                return
+            yield packet
+            # The caller is done with the previous packet: recycle its frame buffer
+            self.release(packet)
+
+    def stop(self):
+        """Stop all stages and wait for them to exit."""
+        self.stop_event.set()
+        if self.started:
+            for thread in self.threads:
+                thread.join(timeout=2.0)
@@ -0,0 +1,376 @@
+# Title: Multi-process frame pipeline - decoder and workers share frames through a shared-memory ring
+
+import multiprocessing as mp
+import queue
+import threading
+import time
+from collections import deque
+from multiprocessing import shared_memory
+
+import cv2
+import numpy as np
+
+from detection_filter import DetectionFilter, draw_detections
+from inference_backend import load_backend
+from pipeline import FramePacket
+from roi_config import compile_roi_config
+from roi_crop import CroppedDetector, crop_inference_size, roi_crop_rects
+from roi_overlay import ROIOverlay
+from roi_tiles import TiledDetector, roi_tile_rects
+
+
+class FrameRing:
+    """A fixed number of equally sized uint8 frame slots in one shared memory block.
+
+    The creating process owns (and finally unlinks) the block; other
+    processes attach to it by name. view(slot) is a NumPy array backed
+    directly by the shared memory, so nothing is copied to read or write it.
+    """
+
+    def __init__(self, slots, frame_shape, name=None):
+        self.slots = int(slots)
+        self.frame_shape = tuple(frame_shape)
+        size = self.slots * int(np.prod(self.frame_shape))
+        self.owner = name is None
+        self.shm = shared_memory.SharedMemory(name=name, create=self.owner, size=size if self.owner else 0)
+        self.frames = np.ndarray((self.slots,) + self.frame_shape, np.uint8, buffer=self.shm.buf)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def view(self, slot):
+        return self.frames[slot]
+
+    def close(self):
+        # The array must let go of the buffer before the mapping can be closed
+        self.frames = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def _worker_main(ring_name, slots, frame_shape, stage_factory, tasks, results, batch_size):
+    """Worker process: infer + post-process frames in place in the ring, send back detections."""
+    ring = FrameRing(slots, frame_shape, ring_name)
+    try:
+        try:
+            infer_fn, postprocess_fn, info = stage_factory()
+        except Exception as e:
+            results.put(("error", f"Worker setup failed: {e}"))
+            return
+        results.put(("ready", info))
+
+        done = False
+        while not done:
+            task = tasks.get()
+            if task is None:
+                break
+            batch = [task]
+            while len(batch) < batch_size:
+                try:
+                    task = tasks.get_nowait()
+                except queue.Empty:
+                    break
+                if task is None:
+                    done = True
+                    break
+                batch.append(task)
+
+            packets = [FramePacket(index, timestamp_ms, ring.view(slot)) for slot, index, timestamp_ms in batch]
+            try:
+                raws = infer_fn([p.frame for p in packets])
+            except Exception as e:
+                # Like FramePipeline: the frames are reported and dropped, the run goes on
+                indices = ", ".join(str(packet.index) for packet in packets)
+                for slot, index, _ in batch:
+                    results.put(("failed", slot, index, f"Error during inference on frame(s) {indices}: {e}"))
+                continue
+            for (slot, _, _), packet, raw in zip(batch, packets, raws):
+                packet.raw = raw
+                try:
+                    postprocess_fn(packet)
+                except Exception as e:
+                    results.put(("failed", slot, packet.index, f"Error processing detections on frame "
+                                                               f"{packet.index}: {e}"))
+                    continue
+                results.put(("frame", slot, packet.index, packet.timestamp_ms, packet.detections))
+        results.put(("done", None))
+    finally:
+        ring.close()
+
+
+class ProcessFramePipeline:
+    """Decode in this process, infer and post-process in worker processes.
+
+    The decoder writes every analyzed frame straight into a free slot of a
+    FrameRing (cap.retrieve / cv2.resize into the slot) and sends only
+    (slot, index, timestamp) to the workers. Workers run infer_fn and
+    postprocess_fn on the slot in place (drawing included) and return the
+    filtered Detections; the caller iterates packets in frame order and a
+    slot is recycled as soon as the caller asks for the next packet. Frames
+    are never copied between processes, and memory is bounded by ring_slots.
+
+    stage_factory must be picklable; each worker calls it once to build
+    (infer_fn, postprocess_fn, info). info (e.g. class names) is sent back
+    and available as stage_info after start(). Workers are started with the
+    "spawn" method on every platform, so scripts using this class need an
+    if __name__ == "__main__" guard.
+
+    A frame whose inference or post-processing fails is reported and
+    dropped (its slot recycled), as in FramePipeline; only a worker that
+    fails to set up or dies ends the run.
+
+    The same caveats as FramePipeline apply to frame_stride and frame_size.
+    Per-frame state that depends on the previous frame (tracking, motion
+    gating) cannot be split across workers and is not supported here.
+    """
+
+    def __init__(self, cap, stage_factory, workers=2, ring_slots=None, frame_stride=1,
+                 frame_size=None, batch_size=1):
+        self.cap = cap
+        self.stage_factory = stage_factory
+        self.workers = max(1, int(workers))
+        self.batch_size = max(1, int(batch_size))
+        # Enough slots to keep every worker busy with a full batch while the sink holds one
+        self.ring_slots = ring_slots or self.workers * self.batch_size * 2 + 2
+        self.frame_stride = max(1, int(frame_stride))
+        self.source_size = (int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+        self.frame_size = tuple(frame_size) if frame_size else self.source_size
+        self.scale = None
+        self.reached_end = False
+        self.frames_decoded = 0
+        self.stage_info = None
+
+        self.ring = None
+        self.processes = []
+        self.free_slots = queue.Queue()
+        self.order = deque()  # frame indices in decode order, for re-ordering worker output
+        self.stop_event = threading.Event()
+        self.decode_thread = threading.Thread(target=self._decode_loop, name="decode", daemon=True)
+        self.started = False
+
+    def start(self):
+        """Start the workers and wait until each one has built its stage."""
+        if self.started:
+            return
+        self.started = True
+        width, height = self.frame_size
+        self.ring = FrameRing(self.ring_slots, (height, width, 3))
+        for slot in range(self.ring_slots):
+            self.free_slots.put(slot)
+
+        ctx = mp.get_context("spawn")
+        self.tasks = ctx.Queue()
+        self.results = ctx.Queue()
+        for i in range(self.workers):
+            process = ctx.Process(target=_worker_main, name=f"frame-worker-{i + 1}", daemon=True,
+                                  args=(self.ring.name, self.ring_slots, self.ring.frame_shape,
+                                        self.stage_factory, self.tasks, self.results, self.batch_size))
+            process.start()
+            self.processes.append(process)
+
+        for _ in range(self.workers):
+            kind, info = self._next_result()
+            if kind != "ready":
+                self.stop()
+                raise RuntimeError(info)
+            self.stage_info = info
+        self.decode_thread.start()
+
+    def _next_result(self):
+        while not self.stop_event.is_set():
+            try:
+                return self.results.get(timeout=0.1)
+            except queue.Empty:
+                crashed = [p for p in self.processes if p.exitcode not in (None, 0)]
+                if crashed:
+                    return ("error", f"Worker {crashed[0].name} exited with code {crashed[0].exitcode}")
+        return ("stopped", None)
+
+    def _read_into(self, slot):
+        """Decode the next analyzed frame into a ring slot; returns False at the end."""
+        while True:
+            if not self.cap.grab():
+                return False
+            self.frames_decoded += 1
+            if (self.frames_decoded - 1) % self.frame_stride == 0:
+                break
+
+        view = self.ring.view(slot)
+        if self.source_size == self.frame_size:
+            ret, frame = self.cap.retrieve(view)
+            if ret and frame is not view:
+                np.copyto(view, frame)
+            return ret
+        ret, frame = self.cap.retrieve()
+        if not ret:
+            return False
+        self.scale = (frame.shape[1] / self.frame_size[0], frame.shape[0] / self.frame_size[1])
+        cv2.resize(frame, self.frame_size, view, interpolation=cv2.INTER_AREA)
+        return True
+
+    def _decode_loop(self):
+        try:
+            while not self.stop_event.is_set():
+                try:
+                    slot = self.free_slots.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if not self._read_into(slot):
+                    print("End of video or failed to read frame")
+                    self.reached_end = True
+                    break
+                self.order.append(self.frames_decoded)
+                self.tasks.put((slot, self.frames_decoded, self.cap.get(cv2.CAP_PROP_POS_MSEC)))
+        except Exception as e:
+            print(f"Error decoding frame {self.frames_decoded + 1}: {e}")
+        for _ in self.processes:
+            self.tasks.put(None)
+
+    def __iter__(self):
+        self.start()
+        pending = {}
+        finished = 0
+        held_slot = None
+        try:
+            while True:
+                if held_slot is not None:
+                    # The caller is done with the previous packet: recycle its slot
+                    self.free_slots.put(held_slot)
+                    held_slot = None
+                if self.order and self.order[0] in pending:
+                    packet, slot = pending.pop(self.order.popleft())
+                    if packet is None:
+                        # Failed frame: nothing to show, the slot is free again
+                        self.free_slots.put(slot)
+                        continue
+                    held_slot = slot
+                    yield packet
+                    continue
+                if finished == self.workers:
+                    break
+
+                message = self._next_result()
+                kind = message[0]
+                if kind == "frame":
+                    _, slot, index, timestamp_ms, detections = message
+                    packet = FramePacket(index, timestamp_ms, self.ring.view(slot))
+                    packet.detections = detections
+                    packet.scale = self.scale
+                    pending[index] = (packet, slot)
+                elif kind == "failed":
+                    _, slot, index, error = message
+                    print(error)
+                    pending[index] = (None, slot)
+                elif kind == "done":
+                    finished += 1
+                elif kind == "error":
+                    print(message[1])
+                    break
+                else:
+                    break
+        finally:
+            self.stop()
+
+    def stop(self):
+        if self.stop_event.is_set():
+            return
+        self.stop_event.set()
+        if self.decode_thread.is_alive():
+            self.decode_thread.join(timeout=2.0)
+        # Workers cannot exit while their queued results are unread, so drain them meanwhile
+        deadline = time.monotonic() + 5.0
+        while any(p.is_alive() for p in self.processes) and time.monotonic() < deadline:
+            try:
+                self.results.get(timeout=0.05)
+            except queue.Empty:
+                pass
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+        if self.ring is not None:
+            self.ring.close()
+            self.ring = None
+
+
+class DetectionStage:
+    """Picklable recipe for main.py's per-frame work, built once in each worker.
+
+    Loads the YOLO model on the chosen inference backend (see
+    inference_backend.py), compiles the ROI set (and optional per-ROI
+    rules, see roi_rules.py) at the processing frame size and returns
+    (infer_fn, postprocess_fn, class_names); postprocess_fn filters the
+    detections and, with render=True, draws boxes, the ROI overlay and the
+    frame counter into the shared frame. The model is warmed up with
+    warmup_runs dummy batches before the worker reports ready.
+    """
+
+    def __init__(self, model_path, imgsz, roi_config_path, roi_cache_dir, frame_size, allowed_class_ids,
+                 conf_threshold, render=True, fill_alpha=0.0, roi_crop=None, total_frames=0, threads=1,
+                 rules=None, model_class_filter=True, roi_tiles=None, backend="ultralytics",
+                 input_shape=None, cache_dir=None, warmup_runs=0, batch_size=1):
+        self.model_path = model_path
+        self.imgsz = imgsz
+        self.roi_config_path = roi_config_path
+        self.roi_cache_dir = roi_cache_dir
+        self.frame_size = tuple(frame_size)
+        self.allowed_class_ids = list(allowed_class_ids)
+        self.conf_threshold = conf_threshold
+        self.render = render
+        self.fill_alpha = fill_alpha
+        self.roi_crop = roi_crop  # (padding, merge_gap) or None
+        self.total_frames = total_frames
+        self.threads = threads
+        self.rules = rules
+        self.model_class_filter = model_class_filter
+        self.roi_tiles = roi_tiles  # (far, near, overlap, imgsz, full_frame, nms_iou) or None
+        self.backend = backend
+        self.input_shape = input_shape
+        self.cache_dir = cache_dir
+        self.warmup_runs = warmup_runs
+        self.batch_size = batch_size
+
+    def __call__(self):
+        cv2.setNumThreads(self.threads)
+        model = load_backend(self.backend, self.model_path, self.threads, self.input_shape, self.cache_dir)
+        class_names = model.names
+
+        width, height = self.frame_size
+        roi_index, _ = compile_roi_config(self.roi_config_path, width, height, self.roi_cache_dir)
+        detection_filter = DetectionFilter(roi_index, self.allowed_class_ids, self.conf_threshold, self.rules)
+        roi_overlay = ROIOverlay(roi_index.polygons, roi_index.names, fill_alpha=self.fill_alpha)
+        options = {}
+        if self.model_class_filter:
+            options.update(classes=detection_filter.table.model_classes, conf=detection_filter.table.model_conf)
+
+        def run_inference(frames, imgsz=self.imgsz):
+            return model(frames, imgsz, **options)
+
+        detector = run_inference
+        if self.roi_tiles is not None:
+            far, near, overlap, tile_imgsz, full_frame, nms_iou = self.roi_tiles
+            detector = TiledDetector(lambda tiles: run_inference(tiles, tile_imgsz),
+                                     roi_tile_rects(roi_index, far, near, overlap),
+                                     run_inference if full_frame else None, nms_iou)
+        elif self.roi_crop is not None:
+            crop_rects = roi_crop_rects(roi_index, *self.roi_crop)
+            crop_imgsz = crop_inference_size(crop_rects, width, height, self.imgsz)
+            detector = CroppedDetector(lambda crops: run_inference(crops, crop_imgsz), crop_rects)
+
+        # Warm up before reporting ready, so the first real frames run at full speed
+        warmup_frames = [np.full((height, width, 3), 114, np.uint8)] * self.batch_size
+        for _ in range(self.warmup_runs):
+            detector(warmup_frames)
+
+        def postprocess(packet):
+            packet.detections = detection_filter(packet.raw)
+            if not self.render:
+                return
+            draw_detections(packet.frame, packet.detections, class_names)
+            roi_overlay.apply(packet.frame)
+            cv2.putText(packet.frame, f"Frame: {packet.index}/{self.total_frames}", (10, 30),
+                        cv2.FONT_HERSHEY_SIMPLEX, 0.7, (255, 255, 255), 2)
+
+        return detector, postprocess, class_names
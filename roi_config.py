@@ -0,0 +1,135 @@
+# Title: ROI sets loaded from roi_polygons.json, compiled once and hot-reloaded while running
+
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+
+from roi_index import ROIIndex, load_roi_session
+
+# Bump when the layout of the compiled .npz files changes
+COMPILED_VERSION = 1
+
+
+def resolve_roi_config(path):
+    """Accept a mapper session folder or the roi_polygons.json file itself."""
+    if os.path.isdir(path):
+        return os.path.join(path, "roi_polygons.json")
+    return path
+
+
+def compile_roi_config(path, frame_width, frame_height, cache_dir=None):
+    """Load a roi_polygons.json into an ROIIndex for the given frame size.
+
+    ROIs drawn on a different resolution are rescaled (see load_roi_session).
+
+    With cache_dir set, the compiled form (polygons, bounding boxes, label
+    map) is stored as <sha1 of the file>_<w>x<h>.npz and reused as long as
+    the file content does not change, so restarts skip rasterization.
+    Returns (roi_index, sha1).
+    """
+    path = resolve_roi_config(path)
+    with open(path, "rb") as f:
+        content = f.read()
+    digest = hashlib.sha1(content).hexdigest()
+
+    compiled_file = None
+    if cache_dir:
+        compiled_file = os.path.join(cache_dir, f"{digest}_{frame_width}x{frame_height}.npz")
+        if os.path.exists(compiled_file):
+            try:
+                with np.load(compiled_file) as data:
+                    if int(data["version"]) == COMPILED_VERSION:
+                        polygons = np.split(data["points"], data["offsets"][1:-1])
+                        names = json.loads(str(data["names"]))
+                        return ROIIndex(polygons, names, frame_width, frame_height, data["label_map"]), digest
+            except (OSError, KeyError, ValueError):
+                pass  # unreadable or stale artifact: recompile below
+
+    names, polygons, _ = load_roi_session(path, (frame_width, frame_height))
+    roi_index = ROIIndex(polygons, names, frame_width, frame_height)
+
+    if compiled_file is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        offsets = np.cumsum([0] + [len(p) for p in roi_index.polygons])
+        points = np.concatenate(roi_index.polygons) if roi_index.polygons else np.zeros((0, 2), np.int32)
+        tmp_file = compiled_file + ".tmp"
+        with open(tmp_file, "wb") as f:
+            np.savez(f, version=COMPILED_VERSION, names=json.dumps(roi_index.names), points=points,
+                     offsets=offsets, bboxes=roi_index.bboxes, label_map=roi_index.label_map)
+        os.replace(tmp_file, compiled_file)
+    return roi_index, digest
+
+
+class ROIConfigWatcher:
+    """Watches a roi_polygons.json and compiles new versions in the background.
+
+    The initial ROI set is compiled synchronously (current). A daemon
+    thread polls the file's mtime/size every poll_interval seconds; when the
+    content hash changes it compiles the new set off the frame path and
+    parks it in pending. The frame loop calls poll() between frames, which
+    hands over the new ROIIndex exactly once, so the swap is a single
+    reference assignment and no frame is dropped. A file that fails to
+    parse (e.g. caught mid-write) keeps the previous set and is retried.
+    """
+
+    def __init__(self, path, frame_width, frame_height, cache_dir=None, poll_interval=1.0):
+        self.path = resolve_roi_config(path)
+        self.frame_width = frame_width
+        self.frame_height = frame_height
+        self.cache_dir = cache_dir
+        self.poll_interval = poll_interval
+
+        self.file_state = self._stat()
+        self.current, self.digest = compile_roi_config(self.path, frame_width, frame_height, cache_dir)
+        self.pending = None
+        self.reloads = 0
+        self.lock = threading.Lock()
+        self.failed_state = None
+
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._watch_loop, name="roi-watcher", daemon=True)
+        self.thread.start()
+
+    def _stat(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def _watch_loop(self):
+        while not self.stop_event.wait(self.poll_interval):
+            state = self._stat()
+            if state is None or state == self.file_state:
+                continue
+            try:
+                roi_index, digest = compile_roi_config(self.path, self.frame_width, self.frame_height,
+                                                       self.cache_dir)
+            except (OSError, KeyError, ValueError) as e:
+                # json.JSONDecodeError is a ValueError; file_state stays old so we retry
+                if state != self.failed_state:
+                    print(f"Warning: Could not reload ROIs from '{self.path}': {e} (keeping previous ROIs)")
+                    self.failed_state = state
+                continue
+            self.file_state = state
+            if digest != self.digest:
+                self.digest = digest
+                with self.lock:
+                    self.pending = roi_index
+
+    def poll(self):
+        """Return the newly compiled ROIIndex once after a change, else None."""
+        if self.pending is None:
+            return None
+        with self.lock:
+            roi_index, self.pending = self.pending, None
+        self.current = roi_index
+        self.reloads += 1
+        return roi_index
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join(timeout=self.poll_interval + 1.0)
@@ -0,0 +1,77 @@
+# Title: ROI-cropped inference - run the detector only on the regions around the ROIs
+
+import math
+
+from detection_filter import Detections
+
+
+def _rects_touch(a, b, gap):
+    return (a[0] <= b[2] + gap and b[0] <= a[2] + gap and
+            a[1] <= b[3] + gap and b[1] <= a[3] + gap)
+
+
+def roi_crop_rects(roi_index, padding=16, merge_gap=32):
+    """Return the crop rectangles (x1, y1, x2, y2) covering all ROIs.
+
+    Each polygon's bounding rect is padded (so boxes whose center is in the
+    ROI are not cut off too much) and clipped to the frame. Rects closer
+    than merge_gap pixels are merged into their union, so the crops never
+    overlap and no object is detected twice.
+    """
+    rects = []
+    for x1, y1, x2, y2 in roi_index.bboxes.tolist():
+        rects.append([max(0, x1 - padding), max(0, y1 - padding),
+                      min(roi_index.frame_width, x2 + padding),
+                      min(roi_index.frame_height, y2 + padding)])
+
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(rects)):
+            for j in range(i + 1, len(rects)):
+                if _rects_touch(rects[i], rects[j], merge_gap):
+                    a, b = rects[i], rects.pop(j)
+                    rects[i] = [min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])]
+                    merged = True
+                    break
+            if merged:
+                break
+
+    return [tuple(r) for r in rects if r[2] > r[0] and r[3] > r[1]]
+
+
+def crop_inference_size(rects, frame_width, frame_height, full_imgsz=640, stride=32):
+    """Inference size for the crops that keeps objects at the same scale as
+    full-frame inference at full_imgsz (rounded up to the model stride)."""
+    scale = min(1.0, full_imgsz / max(frame_width, frame_height))
+    longest = max(max(x2 - x1, y2 - y1) for x1, y1, x2, y2 in rects)
+    return min(full_imgsz, int(math.ceil(longest * scale / stride)) * stride)
+
+
+class CroppedDetector:
+    """Wraps a batch detector so it only sees the ROI crops of each frame.
+
+    All crops of all frames in a micro-batch go through one infer_fn call;
+    boxes are shifted back to full-frame coordinates before filtering.
+    """
+
+    def __init__(self, infer_fn, rects):
+        self.infer_fn = infer_fn
+        self.rects = list(rects)
+
+    def pixel_fraction(self, frame_width, frame_height):
+        area = sum((x2 - x1) * (y2 - y1) for x1, y1, x2, y2 in self.rects)
+        return area / float(frame_width * frame_height)
+
+    def __call__(self, frames):
+        rects = self.rects  # one ROI set for the whole batch, even if rects is replaced meanwhile
+        crops = [frame[y1:y2, x1:x2] for frame in frames for x1, y1, x2, y2 in rects]
+        results = self.infer_fn(crops)
+
+        per_frame = []
+        n = len(rects)
+        for i in range(len(frames)):
+            parts = [raw.offset(x1, y1)
+                     for raw, (x1, y1, _, _) in zip(results[i * n:(i + 1) * n], rects)]
+            per_frame.append(Detections.concatenate(parts))
+        return per_frame
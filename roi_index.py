@@ -0,0 +1,124 @@
+# Title: Rasterized ROI index for fast point-in-polygon lookups
+
+import json
+import os
+
+import cv2
+import numpy as np
+
+
+class ROIIndex:
+    """Rasterizes polygon ROIs once into a per-pixel bitmask label map.
+
+    Bit i of a pixel is set when the pixel lies inside polygon i, so
+    overlapping ROIs are supported. Membership for any number of points
+    is then a single array lookup, independent of the number of polygons
+    or vertices. Pixels on a polygon edge follow cv2.fillPoly rasterization.
+
+    A label_map compiled earlier for the same polygons and frame size (see
+    roi_config.py) can be passed in to skip rasterization.
+    """
+
+    def __init__(self, polygons, names, frame_width, frame_height, label_map=None):
+        if len(polygons) != len(names):
+            raise ValueError("polygons and names must have the same length")
+        if len(polygons) > 64:
+            raise ValueError(f"At most 64 ROIs are supported, got {len(polygons)}")
+
+        self.names = list(names)
+        self.polygons = [np.array(p, np.int32).reshape(-1, 2) for p in polygons]
+        self.frame_width = int(frame_width)
+        self.frame_height = int(frame_height)
+
+        # Smallest unsigned dtype that has one bit per ROI
+        if len(self.polygons) <= 8:
+            self.dtype = np.uint8
+        elif len(self.polygons) <= 16:
+            self.dtype = np.uint16
+        elif len(self.polygons) <= 32:
+            self.dtype = np.uint32
+        else:
+            self.dtype = np.uint64
+
+        # Bounding rect of each polygon as (x1, y1, x2, y2), x2/y2 exclusive
+        self.bboxes = np.array([(x, y, x + w, y + h) for x, y, w, h in map(cv2.boundingRect, self.polygons)],
+                               np.int32).reshape(-1, 4)
+
+        if label_map is not None:
+            if label_map.shape != (self.frame_height, self.frame_width) or label_map.dtype != self.dtype:
+                raise ValueError(f"label_map must be {self.frame_width}x{self.frame_height} "
+                                 f"{np.dtype(self.dtype).name}, got {label_map.shape} {label_map.dtype}")
+            self.label_map = label_map
+            return
+
+        self.label_map = np.zeros((self.frame_height, self.frame_width), self.dtype)
+        scratch = np.zeros((self.frame_height, self.frame_width), np.uint8)
+        for i, pts in enumerate(self.polygons):
+            scratch[:] = 0
+            cv2.fillPoly(scratch, [pts], 1)
+            self.label_map[scratch.view(bool)] |= self.dtype(1 << i)
+
+    def __len__(self):
+        return len(self.polygons)
+
+    def lookup(self, xs, ys):
+        """Return the ROI bitmask for each (x, y) point; 0 means outside all ROIs."""
+        xs = np.asarray(xs).astype(np.intp, copy=False).ravel()
+        ys = np.asarray(ys).astype(np.intp, copy=False).ravel()
+        bits = np.zeros(xs.shape[0], self.dtype)
+        inside = (xs >= 0) & (xs < self.frame_width) & (ys >= 0) & (ys < self.frame_height)
+        bits[inside] = self.label_map[ys[inside], xs[inside]]
+        return bits
+
+    def contains(self, xs, ys):
+        """Return a boolean array: True where the point falls in any ROI."""
+        return self.lookup(xs, ys) != 0
+
+    def membership(self, bits):
+        """Expand bitmasks into an (N, num_rois) boolean matrix."""
+        bits = np.asarray(bits, self.dtype)
+        shifts = np.arange(len(self.polygons), dtype=self.dtype)
+        return ((bits[:, None] >> shifts) & 1).astype(bool)
+
+    def names_for(self, bits):
+        """Return the ROI names encoded in a single bitmask."""
+        bits = int(bits)
+        return [name for i, name in enumerate(self.names) if bits >> i & 1]
+
+
+def load_roi_session(path, frame_size=None):
+    """Load a roi_polygons.json written by bounding_box_mapper.py.
+
+    path may be the JSON file itself or its session folder under
+    roi_mapping_results/. Returns (names, polygons, (width, height)) where
+    (width, height) is the frame size the ROIs were drawn on.
+
+    With frame_size (width, height) given, the polygons are returned in
+    that frame's pixels instead: taken from "points_normalized" (0..1,
+    written by newer mapper sessions) or scaled from "points" by the ratio
+    of the two frame sizes.
+    """
+    if os.path.isdir(path):
+        path = os.path.join(path, "roi_polygons.json")
+    with open(path) as f:
+        data = json.load(f)
+
+    size = data.get("frame_size", {})
+    drawn_size = (size.get("width"), size.get("height"))
+    names = [p["name"] for p in data["polygons"]]
+
+    if frame_size is None or tuple(frame_size) == drawn_size:
+        polygons = [np.array(p["points"], np.int32).reshape(-1, 2) for p in data["polygons"]]
+        return names, polygons, drawn_size
+
+    target = np.array(frame_size, np.float64)
+    polygons = []
+    for p in data["polygons"]:
+        if "points_normalized" in p:
+            normalized = np.array(p["points_normalized"], np.float64).reshape(-1, 2)
+        elif drawn_size[0] and drawn_size[1]:
+            normalized = np.array(p["points"], np.float64).reshape(-1, 2) / drawn_size
+        else:
+            raise ValueError(f"'{path}' has no frame_size, so its ROIs cannot be rescaled")
+        polygons.append(np.round(normalized * target).astype(np.int32))
+    return names, polygons, drawn_size
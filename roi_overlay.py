@@ -0,0 +1,90 @@
+# Title: Pre-rendered static ROI overlay (outlines, fills, labels) composited per frame
+
+import cv2
+import numpy as np
+
+# BGR colors cycled over the ROIs when none are given
+DEFAULT_COLORS = [(255, 0, 0), (0, 0, 255), (0, 255, 0), (0, 255, 255), (255, 0, 255), (255, 255, 0)]
+
+
+def _bounding_slices(mask):
+    ys, xs = np.nonzero(mask)
+    if ys.size == 0:
+        return None
+    return slice(ys.min(), ys.max() + 1), slice(xs.min(), xs.max() + 1)
+
+
+class ROIOverlay:
+    """Draws ROI outlines, optional alpha fills and labels from a cached layer.
+
+    The overlay is rendered once; every frame then costs one indexed copy of
+    the outline and label pixels and, with fill_alpha > 0, one blend limited
+    to the bounding box of the filled polygons. The
+    cache is rebuilt only when set_rois() changes the ROI set or the frame
+    size changes.
+    """
+
+    def __init__(self, polygons, names, colors=None, fill_alpha=0.0, thickness=1, font_scale=0.6):
+        self.fill_alpha = fill_alpha
+        self.thickness = thickness
+        self.font_scale = font_scale
+        self.set_rois(polygons, names, colors)
+
+    def set_rois(self, polygons, names, colors=None):
+        self.polygons = [np.array(p, np.int32).reshape(-1, 2) for p in polygons]
+        self.names = list(names)
+        self.colors = list(colors) if colors else [DEFAULT_COLORS[i % len(DEFAULT_COLORS)]
+                                                  for i in range(len(self.polygons))]
+        self.size = None
+
+    def _render(self, height, width):
+        layer = np.zeros((height, width, 3), np.uint8)
+        line_mask = np.zeros((height, width), np.uint8)
+        fill_layer = np.zeros((height, width, 3), np.uint8)
+        fill_mask = np.zeros((height, width), np.uint8)
+
+        for pts, name, color in zip(self.polygons, self.names, self.colors):
+            if self.fill_alpha > 0:
+                cv2.fillPoly(fill_layer, [pts], color)
+                cv2.fillPoly(fill_mask, [pts], 255)
+            cv2.polylines(layer, [pts], True, color, self.thickness)
+            cv2.polylines(line_mask, [pts], True, 255, self.thickness)
+            origin = (int(pts[0][0]), int(pts[0][1]) - 10)
+            cv2.putText(layer, name, origin, cv2.FONT_HERSHEY_SIMPLEX, self.font_scale, color, 2)
+            cv2.putText(line_mask, name, origin, cv2.FONT_HERSHEY_SIMPLEX, self.font_scale, 255, 2)
+
+        # Outlines and labels are opaque, so they are excluded from the fill blend
+        fill_mask[line_mask != 0] = 0
+
+        # Outline/label pixels are few, so they are kept as index arrays rather than a mask
+        self.line_pixels = np.nonzero(line_mask == 255)
+        self.line_colors = layer[self.line_pixels]
+        # Anti-aliased edge pixels (OpenCV builds that smooth text) are blended by coverage;
+        # the layer there already holds color * coverage
+        self.edge_pixels = np.nonzero((line_mask > 0) & (line_mask < 255))
+        self.edge_alpha = (line_mask[self.edge_pixels] / 255.0).astype(np.float32)[:, None]
+        self.edge_colors = layer[self.edge_pixels].astype(np.float32)
+
+        self.fill_box = _bounding_slices(fill_mask) if self.fill_alpha > 0 else None
+        if self.fill_box is not None:
+            self.fill_layer = fill_layer[self.fill_box]
+            self.fill_mask = (fill_mask[self.fill_box] != 0)[..., None]
+            self.fill_blend = np.empty_like(self.fill_layer)
+
+        self.size = (height, width)
+
+    def apply(self, frame):
+        """Composite the overlay onto frame in place."""
+        height, width = frame.shape[:2]
+        if self.size != (height, width):
+            self._render(height, width)
+
+        if self.fill_box is not None:
+            region = frame[self.fill_box]
+            cv2.addWeighted(region, 1.0 - self.fill_alpha, self.fill_layer, self.fill_alpha, 0, self.fill_blend)
+            np.copyto(region, self.fill_blend, where=self.fill_mask)
+        frame[self.line_pixels] = self.line_colors
+        if self.edge_alpha.size:
+            under = frame[self.edge_pixels].astype(np.float32)
+            frame[self.edge_pixels] = np.clip(under * (1.0 - self.edge_alpha) + self.edge_colors + 0.5, 0, 255)
+        return frame
@@ -0,0 +1,86 @@
+# Title: Per-ROI class / confidence rules compiled into a dense (roi x class) threshold table
+#
+# roi_rules.json lives next to roi_polygons.json in the mapper session folder:
+#   {
+#     "default": {"classes": [1, 2, 3, 5, 7, 9], "min_conf": 0.25},
+#     "class_min_conf": {"0": 0.5},
+#     "rois": {
+#       "crosswalk": {"classes": [0], "min_conf": 0.4},
+#       "road1": {"classes": {"2": 0.3, "5": 0.3, "7": 0.5}}
+#     }
+#   }
+# "classes" is a list of class IDs (all at the rule's min_conf) or {class_id: min_conf}.
+# ROIs without an entry use "default"; "class_min_conf" raises the floor of a class in
+# every ROI. A missing "default" falls back to main.py's allowed_class_ids / conf_threshold.
+
+import json
+import os
+
+import numpy as np
+
+RULES_FILENAME = "roi_rules.json"
+
+# Threshold of a (roi, class) pair that is never kept
+DISALLOWED = np.float32(np.inf)
+
+
+def rules_path_for(roi_config_path):
+    """Path of the roi_rules.json that belongs to an ROI session folder or roi_polygons.json."""
+    folder = roi_config_path if os.path.isdir(roi_config_path) else os.path.dirname(roi_config_path)
+    return os.path.join(folder, RULES_FILENAME)
+
+
+def load_roi_rules(path):
+    """Load a rules file; returns None when it does not exist."""
+    if not path or not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def _class_thresholds(rule, default_conf):
+    floor = float(rule.get("min_conf", default_conf))
+    classes = rule.get("classes", [])
+    if isinstance(classes, dict):
+        return {int(c): float(conf) for c, conf in classes.items()}
+    return {int(c): floor for c in classes}
+
+
+class ROIRuleTable:
+    """Dense (num_rois, num_classes) table of minimum confidences.
+
+    min_conf[r, c] is the lowest confidence at which class c is kept in
+    ROI r (DISALLOWED = never), so the final decision for any number of
+    (detection, ROI) pairs is one gather and one comparison. model_classes
+    (the union of allowed classes) and model_conf (the lowest threshold)
+    are what the model itself can be asked for, so nothing that every ROI
+    rejects is produced at all.
+    """
+
+    def __init__(self, roi_names, rules=None, default_classes=(), default_conf=0.0):
+        rules = rules or {}
+        default_rule = rules.get("default", {"classes": list(default_classes), "min_conf": default_conf})
+        default = _class_thresholds(default_rule, default_conf)
+        class_floor = {int(c): float(conf) for c, conf in rules.get("class_min_conf", {}).items()}
+        roi_rules = rules.get("rois", {})
+        unknown = sorted(set(roi_rules) - set(roi_names))
+        if unknown:
+            print(f"Warning: ROI rules for unknown ROI(s) {unknown} are ignored")
+
+        per_roi = [_class_thresholds(roi_rules[name], default_conf) if name in roi_rules else default
+                   for name in roi_names]
+        num_classes = max([c for thresholds in per_roi for c in thresholds] + [-1]) + 1
+
+        self.roi_names = list(roi_names)
+        self.min_conf = np.full((len(per_roi), num_classes), DISALLOWED, np.float32)
+        for r, thresholds in enumerate(per_roi):
+            for c, conf in thresholds.items():
+                self.min_conf[r, c] = max(conf, class_floor.get(c, 0.0))
+
+        allowed = np.isfinite(self.min_conf)
+        self.model_classes = np.nonzero(allowed.any(axis=0))[0].tolist()
+        self.model_conf = float(self.min_conf[allowed].min()) if allowed.any() else 1.0
+
+    @property
+    def num_classes(self):
+        return self.min_conf.shape[1]
@@ -0,0 +1,107 @@
+# Title: ROI-restricted tiled inference - small tiles where the ROIs are far from the camera
+
+import math
+
+import numpy as np
+
+from detection_filter import Detections
+
+
+def _tile_starts(lo, hi, size, step, limit):
+    """Evenly spaced start offsets of tiles of `size` covering [lo, hi) inside [0, limit),
+    at most `step` apart."""
+    first = min(lo, limit - size)
+    last = min(max(first, hi - size), limit - size)
+    count = int(math.ceil((last - first) / step)) + 1
+    return sorted(set(np.linspace(first, last, count).round().astype(int).tolist()))
+
+
+def roi_tile_rects(roi_index, far_tile=160, near_tile=320, overlap=0.25):
+    """Return square tiles (x1, y1, x2, y2) that cover the ROIs and nothing else.
+
+    Tiles are laid out in rows from the top of the ROIs down. The tile size
+    grows linearly from far_tile at the top of the ROIs (far from the
+    camera, where vehicles are a few pixels tall) to near_tile at their
+    bottom, so distant objects are magnified more when every tile is
+    resized to the same inference size. Neighbouring tiles overlap by
+    `overlap` of their size, and only tiles that contain ROI pixels are kept.
+    """
+    mask = roi_index.label_map != 0
+    rows = np.nonzero(mask.any(axis=1))[0]
+    if rows.size == 0:
+        return []
+    width, height = roi_index.frame_width, roi_index.frame_height
+    top, bottom = int(rows[0]), int(rows[-1]) + 1
+    span = max(1, bottom - top)
+
+    tiles = []
+    y = top
+    while True:
+        fraction = min(1.0, max(0.0, (y - top) / span))
+        size = int(round(far_tile + (near_tile - far_tile) * fraction))
+        size = max(1, min(size, width, height))
+        step = max(1, int(size * (1.0 - overlap)))
+        y1 = min(y, height - size)
+
+        cols = np.nonzero(mask[y1:y1 + size].any(axis=0))[0]
+        if cols.size:
+            for x1 in _tile_starts(int(cols[0]), int(cols[-1]) + 1, size, step, width):
+                if mask[y1:y1 + size, x1:x1 + size].any():
+                    tiles.append((x1, y1, x1 + size, y1 + size))
+        if y1 + size >= bottom:
+            break
+        y += step
+    return tiles
+
+
+class TiledDetector:
+    """Wraps a batch detector so it sees ROI tiles instead of whole frames.
+
+    All tiles of all frames in a micro-batch go through one infer_fn call.
+    With full_frame_fn set, the whole frames are also inferred (one more
+    call) to catch objects larger than a tile; boxes that a tile cut off at
+    an edge shared with another tile are then dropped, since the neighbour
+    or the full frame holds the whole object. Tile boxes are shifted back
+    to frame coordinates and duplicates across tiles are merged with
+    class-aware NMS at iou_threshold.
+    """
+
+    def __init__(self, infer_fn, tiles, full_frame_fn=None, iou_threshold=0.5, edge_margin=2):
+        self.infer_fn = infer_fn
+        self.full_frame_fn = full_frame_fn
+        self.iou_threshold = iou_threshold
+        self.edge_margin = edge_margin
+        self.tiles = list(tiles)
+
+    def pixel_fraction(self, frame_width, frame_height):
+        covered = np.zeros((frame_height, frame_width), bool)
+        for x1, y1, x2, y2 in self.tiles:
+            covered[y1:y2, x1:x2] = True
+        return covered.mean()
+
+    def _cut_off(self, raw, tile, frame_width, frame_height):
+        """Mask of boxes touching a tile edge that lies inside the frame."""
+        x1, y1, x2, y2 = tile
+        m = self.edge_margin
+        xyxy = raw.xyxy
+        return (((xyxy[:, 0] <= m) & (x1 > 0)) | ((xyxy[:, 1] <= m) & (y1 > 0)) |
+                ((xyxy[:, 2] >= x2 - x1 - m) & (x2 < frame_width)) |
+                ((xyxy[:, 3] >= y2 - y1 - m) & (y2 < frame_height)))
+
+    def __call__(self, frames):
+        tiles = self.tiles  # one tile set for the whole batch, even if tiles is replaced meanwhile
+        crops = [frame[y1:y2, x1:x2] for frame in frames for x1, y1, x2, y2 in tiles]
+        results = self.infer_fn(crops) if crops else []
+        full = self.full_frame_fn(frames) if self.full_frame_fn is not None else None
+
+        per_frame = []
+        n = len(tiles)
+        for i, frame in enumerate(frames):
+            height, width = frame.shape[:2]
+            parts = [] if full is None else [full[i]]
+            for raw, tile in zip(results[i * n:(i + 1) * n], tiles):
+                if full is not None and len(raw):
+                    raw = raw.select(~self._cut_off(raw, tile, width, height))
+                parts.append(raw.offset(tile[0], tile[1]))
+            per_frame.append(Detections.concatenate(parts).nms(self.iou_threshold))
+        return per_frame
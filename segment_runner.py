@@ -0,0 +1,245 @@
+# Title: Segment runner - one long recorded video processed as parallel frame ranges
+#
+# Usage:
+#   python segment_runner.py recording.mp4 roi_mapping_results/<session> --output detections.jsonl \
+#       --workers 8 --segment-frames 9000
+#
+# The video is split into ranges of --segment-frames frames. Each worker process seeks
+# to the start of its range, runs detection + ROI filtering over that range only and
+# writes a part file; parts are appended to the output in frame order as soon as all
+# earlier segments are done. The output has the same JSON lines as main.py's
+# jsonl_output_path, in the same order a sequential run would produce.
+#
+# --backend onnxruntime runs the --onnx-model file on ONNX Runtime instead of PyTorch (it is
+# exported from --model first if missing).
+
+import argparse
+import math
+import multiprocessing as mp
+import os
+import shutil
+import sys
+import time
+
+import cv2
+
+from detection_filter import DetectionFilter
+from inference_backend import BACKENDS, export_onnx, load_backend
+from outputs import JsonlDetectionWriter
+from pipeline import FramePipeline
+from roi_index import ROIIndex, load_roi_session
+from roi_rules import load_roi_rules, rules_path_for
+
+# --- WORKER PROCESS STATE (set once per worker by _init_worker) ---
+_model = None
+_model_error = None
+
+
+def _init_worker(backend, model_path, threads_per_worker):
+    """Load the model once per worker process."""
+    global _model, _model_error
+    cv2.setNumThreads(threads_per_worker)
+    try:
+        _model = load_backend(backend, model_path, threads_per_worker)
+    except Exception as e:
+        # Reported per segment; raising here would make the pool respawn workers forever
+        _model_error = f"Error loading YOLOv8 model: {e}"
+
+
+class SegmentCapture:
+    """A VideoCapture limited to frames [start, end) of the file.
+
+    Seeking goes through CAP_PROP_POS_FRAMES; backends that land on the
+    preceding keyframe are moved forward with grab() until the exact start
+    frame, and a backend that overshoots is rewound and decoded forward from
+    the beginning, so segments never skip or repeat frames. grab() returns
+    False at end, so FramePipeline stops at the segment boundary.
+    """
+
+    def __init__(self, path, start, end):
+        self.cap = cv2.VideoCapture(path)
+        if not self.cap.isOpened():
+            raise IOError(f"Could not open video file '{path}'")
+        self.start = start
+        self.end = end
+        self.position = self._seek(start)
+
+    def _seek(self, start):
+        if start == 0:
+            return 0
+        self.cap.set(cv2.CAP_PROP_POS_FRAMES, start)
+        position = int(self.cap.get(cv2.CAP_PROP_POS_FRAMES))
+        if position < 0 or position > start:
+            self.cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            position = 0
+        while position < start:
+            if not self.cap.grab():
+                break
+            position += 1
+        return position
+
+    def grab(self):
+        if self.position >= self.end or not self.cap.grab():
+            return False
+        self.position += 1
+        return True
+
+    def retrieve(self, *args):
+        return self.cap.retrieve(*args)
+
+    def get(self, prop):
+        return self.cap.get(prop)
+
+    def release(self):
+        self.cap.release()
+
+
+def split_segments(total_frames, segment_frames, frame_stride=1):
+    """[(start, end), ...] frame ranges; lengths are multiples of frame_stride so the
+    analyzed frames are exactly those of a sequential run."""
+    segment_frames = max(frame_stride, int(math.ceil(segment_frames / frame_stride)) * frame_stride)
+    return [(start, min(start + segment_frames, total_frames))
+            for start in range(0, total_frames, segment_frames)]
+
+
+def _run_segment(task):
+    """Process one frame range into its part file; never raises so the merge can report it."""
+    number, (start, end), part_path, settings = task
+    started = time.monotonic()
+    frames = 0
+    try:
+        if _model is None:
+            raise RuntimeError(_model_error)
+        cap = SegmentCapture(settings["video"], start, end)
+        if cap.position != start:
+            raise IOError(f"Could not seek to frame {start}")
+        width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+
+        roi_names, polygons, _ = load_roi_session(settings["roi_session"], (width, height))
+        roi_index = ROIIndex(polygons, roi_names, width, height)
+        rules = load_roi_rules(rules_path_for(settings["roi_session"]))
+        detection_filter = DetectionFilter(roi_index, settings["allowed_class_ids"], settings["conf_threshold"],
+                                           rules)
+
+        table = detection_filter.table
+
+        def run_inference(frames_batch):
+            # Same model call as main.py: only classes and confidences some ROI keeps
+            return _model(frames_batch, settings["imgsz"], classes=table.model_classes, conf=table.model_conf)
+
+        def filter_frame(packet):
+            # FramePipeline counts from the segment start; make indices global (1-based)
+            packet.index += start
+            packet.detections = detection_filter(packet.raw)
+
+        writer = JsonlDetectionWriter(part_path, _model.names, roi_index)
+        pipeline = FramePipeline(cap, run_inference, filter_frame, batch_size=settings["batch_size"],
+                                 frame_stride=settings["frame_stride"])
+        try:
+            for packet in pipeline:
+                writer.write(packet)
+                frames += 1
+            if not pipeline.reached_end:
+                raise RuntimeError("Segment stopped before its last frame")
+        finally:
+            pipeline.stop()
+            writer.close()
+            cap.release()
+    except Exception as e:
+        return {"segment": number, "status": "failed", "error": str(e), "frames": frames}
+
+    return {"segment": number, "status": "done", "frames": frames,
+            "seconds": round(time.monotonic() - started, 2)}
+
+
+def run(video_path, roi_session, output_path, workers=None, segment_frames=9000, model_path="yolov8n.pt",
+        allowed_class_ids=(1, 2, 3, 5, 7, 9), conf_threshold=0.25, frame_stride=1, batch_size=1, imgsz=640,
+        backend="ultralytics", onnx_model_path="yolov8n.onnx"):
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        raise IOError(f"Could not open video file '{video_path}'")
+    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
+    if total_frames <= 0:
+        raise IOError(f"'{video_path}' does not report a frame count, so it cannot be split")
+
+    weights = onnx_model_path if backend == "onnxruntime" else model_path
+    if backend == "onnxruntime" and not os.path.isfile(weights):
+        # Once here, rather than in every worker at the same time
+        print(f"Exporting '{model_path}' to '{weights}' (first start only)")
+        try:
+            export_onnx(model_path, weights)
+        except Exception as e:
+            raise IOError(f"Could not export '{model_path}' to ONNX: {e}")
+
+    segments = split_segments(total_frames, segment_frames, frame_stride)
+    cores = os.cpu_count() or 1
+    workers = max(1, min(workers or cores, len(segments)))
+    threads_per_worker = max(1, cores // workers)
+    settings = {"video": video_path, "roi_session": roi_session, "allowed_class_ids": list(allowed_class_ids),
+                "conf_threshold": conf_threshold, "frame_stride": frame_stride, "batch_size": batch_size,
+                "imgsz": imgsz}
+
+    parts_dir = output_path + ".parts"
+    os.makedirs(parts_dir, exist_ok=True)
+    tasks = [(i + 1, segment, os.path.join(parts_dir, f"segment_{i + 1:05d}.jsonl"), settings)
+             for i, segment in enumerate(segments)]
+
+    print(f"Processing {total_frames} frames as {len(segments)} segment(s) with {workers} worker(s)")
+    started = time.monotonic()
+    failed = []
+    frames = 0
+    with open(output_path, "wb") as out, \
+            mp.Pool(workers, initializer=_init_worker, initargs=(backend, weights, threads_per_worker)) as pool:
+        # imap keeps segment order, so each part is merged as soon as all earlier ones are done
+        for (number, (start, end), part_path, _), summary in zip(tasks, pool.imap(_run_segment, tasks)):
+            if summary["status"] != "done":
+                failed.append(summary)
+                print(f"Segment {number} (frames {start + 1}-{end}) failed: {summary['error']}")
+                continue
+            with open(part_path, "rb") as part:
+                shutil.copyfileobj(part, out)
+            os.remove(part_path)
+            frames += summary["frames"]
+            elapsed = time.monotonic() - started
+            print(f"Segment {number}/{len(segments)} merged (frames {start + 1}-{end}), "
+                  f"{frames} frames in {elapsed:.1f}s ({frames / elapsed:.1f} FPS)")
+
+    shutil.rmtree(parts_dir, ignore_errors=True)
+    return frames, failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run ROI-filtered detection on one long video in parallel segments")
+    parser.add_argument("video")
+    parser.add_argument("roi_session", help="ROI session folder or roi_polygons.json from bounding_box_mapper.py")
+    parser.add_argument("--output", default="segment_detections.jsonl")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes (default: one per core)")
+    parser.add_argument("--segment-frames", type=int, default=9000,
+                        help="Frames per segment (smaller = better load balancing, more seeks)")
+    parser.add_argument("--model", default="yolov8n.pt")
+    parser.add_argument("--backend", choices=BACKENDS, default="ultralytics")
+    parser.add_argument("--onnx-model", default="yolov8n.onnx", help="ONNX model for --backend onnxruntime")
+    parser.add_argument("--classes", nargs="+", type=int, default=[1, 2, 3, 5, 7, 9])
+    parser.add_argument("--conf-threshold", type=float, default=0.25)
+    parser.add_argument("--frame-stride", type=int, default=1)
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--imgsz", type=int, default=640)
+    args = parser.parse_args()
+
+    if not os.path.exists(args.video):
+        print(f"Error: Video file '{args.video}' not found!")
+        sys.exit(1)
+
+    try:
+        frames, failed = run(args.video, args.roi_session, args.output, args.workers, args.segment_frames,
+                             args.model, args.classes, args.conf_threshold, args.frame_stride,
+                             args.batch_size, args.imgsz, args.backend, args.onnx_model)
+    except IOError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    if failed:
+        print(f"Finished with {len(failed)} failed segment(s); their frames are missing from {args.output}")
+        sys.exit(1)
+    print(f"Finished: {frames} frames written to {args.output}")
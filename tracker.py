@@ -0,0 +1,192 @@
+# Title: Lightweight vectorized IoU tracker so the detector can run every K frames
+
+import numpy as np
+
+from detection_filter import Detections, iou_matrix
+
+
+def center_similarity(a, b, gate=1.0):
+    """1 - center distance / (gate * diagonal of the box in a), clipped at 0, as (N, M)."""
+    ca = (a[:, :2] + a[:, 2:]) / 2
+    cb = (b[:, :2] + b[:, 2:]) / 2
+    diag = np.hypot(a[:, 2] - a[:, 0], a[:, 3] - a[:, 1])
+    dist = np.hypot(ca[:, None, 0] - cb[None, :, 0], ca[:, None, 1] - cb[None, :, 1])
+    return np.clip(1.0 - dist / np.maximum(gate * diag[:, None], 1e-6), 0.0, None)
+
+
+def greedy_match(cost, threshold):
+    """Greedy assignment on an IoU matrix: best pairs first, each row/column used once."""
+    rows, cols = np.nonzero(cost >= threshold)
+    if rows.size == 0:
+        return np.zeros(0, np.intp), np.zeros(0, np.intp)
+    order = np.argsort(-cost[rows, cols], kind="stable")
+    used_rows = np.zeros(cost.shape[0], bool)
+    used_cols = np.zeros(cost.shape[1], bool)
+    matched_rows, matched_cols = [], []
+    for r, c in zip(rows[order].tolist(), cols[order].tolist()):
+        if not used_rows[r] and not used_cols[c]:
+            used_rows[r] = used_cols[c] = True
+            matched_rows.append(r)
+            matched_cols.append(c)
+    return np.array(matched_rows, np.intp), np.array(matched_cols, np.intp)
+
+
+class IoUTracker:
+    """Multi-object tracker over struct-of-arrays track state.
+
+    Tracks are associated with new detections of the same class by IoU
+    against their predicted boxes; tracks left over (typically new tracks
+    whose velocity is still unknown) get a second chance by center
+    distance, gated at center_gate box diagonals. Between detections, boxes move with a
+    constant-velocity model whose velocity is smoothed on every update
+    (an alpha-beta filter, i.e. a steady-state Kalman filter). A track's
+    confidence is its last detection confidence times
+    confidence_decay ** frames_since_detection; tracks not re-detected
+    within max_age frames are dropped.
+    """
+
+    def __init__(self, iou_threshold=0.3, max_age=30, velocity_smoothing=0.5, confidence_decay=0.95,
+                 center_gate=1.0):
+        self.iou_threshold = iou_threshold
+        self.center_gate = center_gate
+        self.max_age = max_age
+        self.velocity_smoothing = velocity_smoothing
+        self.confidence_decay = confidence_decay
+
+        self.boxes = np.zeros((0, 4), np.float32)
+        self.anchor = np.zeros((0, 4), np.float32)  # box at the last detection
+        self.velocity = np.zeros((0, 4), np.float32)
+        self.det_conf = np.zeros(0, np.float32)
+        self.cls = np.zeros(0, np.int32)
+        self.ids = np.zeros(0, np.int64)
+        self.age = np.zeros(0, np.int32)
+        self.next_id = 1
+
+    def __len__(self):
+        return self.ids.shape[0]
+
+    def confidence(self):
+        return self.det_conf * self.confidence_decay ** self.age
+
+    def predict(self):
+        """Propagate all tracks by one frame."""
+        self.boxes = self.boxes + self.velocity
+        self.age += 1
+        self._drop(self.age <= self.max_age)
+
+    def update(self, detections):
+        """Predict one frame ahead, then correct with a fresh set of detections."""
+        self.boxes = self.boxes + self.velocity
+        self.age += 1
+
+        other_class = self.cls[:, None] != detections.cls[None, :]
+        iou = iou_matrix(self.boxes, detections.xyxy)
+        iou[other_class] = 0.0
+        track_idx, det_idx = greedy_match(iou, self.iou_threshold)
+
+        free_tracks = np.setdiff1d(np.arange(len(self)), track_idx)
+        free_dets = np.setdiff1d(np.arange(len(detections)), det_idx)
+        if free_tracks.size and free_dets.size:
+            similarity = center_similarity(self.boxes[free_tracks], detections.xyxy[free_dets],
+                                           self.center_gate)
+            similarity[other_class[np.ix_(free_tracks, free_dets)]] = 0.0
+            extra_tracks, extra_dets = greedy_match(similarity, 1e-6)
+            track_idx = np.concatenate([track_idx, free_tracks[extra_tracks]])
+            det_idx = np.concatenate([det_idx, free_dets[extra_dets]])
+
+        if track_idx.size:
+            new_boxes = detections.xyxy[det_idx]
+            frames_since = self.age[track_idx, None].astype(np.float32)
+            measured = (new_boxes - self.anchor[track_idx]) / frames_since
+            a = self.velocity_smoothing
+            self.velocity[track_idx] = a * measured + (1 - a) * self.velocity[track_idx]
+            self.boxes[track_idx] = new_boxes
+            self.anchor[track_idx] = new_boxes
+            self.det_conf[track_idx] = detections.conf[det_idx]
+            self.age[track_idx] = 0
+
+        self._drop(self.age <= self.max_age)
+
+        new = np.ones(len(detections), bool)
+        new[det_idx] = False
+        count = int(new.sum())
+        if count:
+            self.boxes = np.concatenate([self.boxes, detections.xyxy[new]])
+            self.anchor = np.concatenate([self.anchor, detections.xyxy[new]])
+            self.velocity = np.concatenate([self.velocity, np.zeros((count, 4), np.float32)])
+            self.det_conf = np.concatenate([self.det_conf, detections.conf[new]])
+            self.cls = np.concatenate([self.cls, detections.cls[new]])
+            self.ids = np.concatenate([self.ids, np.arange(self.next_id, self.next_id + count)])
+            self.age = np.concatenate([self.age, np.zeros(count, np.int32)])
+            self.next_id += count
+
+    def _drop(self, keep):
+        if keep.all():
+            return
+        self.boxes = self.boxes[keep]
+        self.anchor = self.anchor[keep]
+        self.velocity = self.velocity[keep]
+        self.det_conf = self.det_conf[keep]
+        self.cls = self.cls[keep]
+        self.ids = self.ids[keep]
+        self.age = self.age[keep]
+
+    def detections(self, max_age=None):
+        """Current tracks as Detections with track_ids set.
+
+        max_age limits the output to tracks detected at most that many frames ago.
+        """
+        keep = slice(None) if max_age is None else self.age <= max_age
+        return Detections(self.boxes[keep].astype(np.float32), self.confidence()[keep].astype(np.float32),
+                          self.cls[keep], track_ids=self.ids[keep])
+
+
+class TrackedDetector:
+    """Wraps a batch detector so it runs only every detect_interval frames.
+
+    Frames in between get the propagated boxes of the tracks confirmed by
+    the most recent detection (unmatched tracks are kept, but not output,
+    so they can be re-associated). Detection runs early when the mean track
+    confidence decays below refresh_confidence.
+    Frames are handled one at a time, because whether frame i needs the
+    detector depends on the tracker state after frame i-1. A detector may
+    return None for a frame (a motion-gate skip); the tracks are then
+    propagated as on any other frame in between, and detection is asked for
+    again on the next frame.
+    """
+
+    def __init__(self, detector, tracker, detect_interval=5, refresh_confidence=0.3):
+        self.detector = detector
+        self.tracker = tracker
+        self.detect_interval = max(1, int(detect_interval))
+        self.refresh_confidence = refresh_confidence
+        self.frames_since_detection = None
+        self.detections_run = 0
+        self.frames_seen = 0
+
+    def _needs_detection(self):
+        if self.frames_since_detection is None or self.frames_since_detection + 1 >= self.detect_interval:
+            return True
+        if len(self.tracker):
+            decayed = self.tracker.confidence() * self.tracker.confidence_decay
+            return float(decayed.mean()) < self.refresh_confidence
+        return False
+
+    def __call__(self, frames):
+        results = []
+        for frame in frames:
+            self.frames_seen += 1
+            raw = self.detector([frame])[0] if self._needs_detection() else None
+            if raw is not None:
+                self.tracker.update(raw)
+                self.frames_since_detection = 0
+                self.detections_run += 1
+            else:
+                self.tracker.predict()
+                self.frames_since_detection = (self.frames_since_detection or 0) + 1
+            results.append(self.tracker.detections(max_age=self.frames_since_detection))
+        return results
+
+    def summary(self):
+        pct = 100.0 * self.detections_run / self.frames_seen if self.frames_seen else 0.0
+        return f"Tracker: detector ran on {self.detections_run} of {self.frames_seen} frames ({pct:.1f}%)"